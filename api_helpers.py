@@ -4,7 +4,7 @@ import base64
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.exceptions import InvalidSignature
-from datetime import datetime
+from datetime import datetime, timedelta
 import requests
 import json
 import numpy as np
@@ -12,6 +12,13 @@ import numpy as np
 from helpers import get_next_sunday, get_previous_sunday
 import config
 
+# when set, call_api is answered by this local exchange simulator instead of Kalshi
+PAPER_EXCHANGE = None
+
+def set_paper_exchange(exchange):
+    # route all API calls to a paper exchange, or back to Kalshi with None
+    global PAPER_EXCHANGE
+    PAPER_EXCHANGE = exchange
 
 def load_private_key_from_file(file_path):
     # message to API will need to be signed with private key
@@ -57,6 +64,10 @@ def call_api(key_file, access_key, method, base_url, path, params={}):
     # path - end of API url specifying the desired action
     # params - call sometimes pass in a dict of info with a message
 
+    if PAPER_EXCHANGE is not None:
+        # paper trading: the local simulator answers instead of the real API
+        return PAPER_EXCHANGE.call_api(method, path, params)
+
     # Get the current time
     current_time = datetime.now()
 
@@ -108,11 +119,13 @@ def get_all_orders(key_file, access_key, method, base_url, path, params={}):
     # get all active orders associated with an event
     return json.loads(call_api(key_file, access_key, method, base_url, path, params))['orders']
 
-def construct_event_ticker(most_recent_cutoff):
+def construct_event_ticker(most_recent_cutoff, week_ahead=0):
     # return the current event ticker as a string, e.g KSTSAW-25JUL13
     # most_recent_cutoff - datetime of most recent date with TSA data
+    # week_ahead - weeks after the current event, e.g. 1 for the event closing the Sunday after
 
     next_sunday = get_next_sunday(most_recent_cutoff) # the current event will close on the next Sunday
+    next_sunday += timedelta(days=7 * week_ahead)
     day = str(next_sunday.day)
     if len(day) == 1:
         day = '0' + day
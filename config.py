@@ -67,3 +67,110 @@ NO_TRADE_END = (10, 30)
 
 # TSA passenger data web page
 SCRAPE_URL = 'https://www.tsa.gov/travel/passenger-volumes/'
+
+# ARMA order used when order selection is disabled
+ARMA_ORDER = (14, 0, 14)
+
+# if True, generate_predictions picks the ARMA order with a grid search instead of using ARMA_ORDER
+SELECT_ARMA_ORDER = True
+
+# candidate AR, differencing, and MA orders for the grid search
+ARMA_P_GRID = [1, 2, 3, 7, 14]
+ARMA_D_GRID = [0]
+ARMA_Q_GRID = [0, 1, 2, 7, 14]
+
+# score used to pick the winning order - 'oos_rmse', 'aic', or 'bic'
+ARMA_SELECTION_CRITERION = 'oos_rmse'
+
+# orders scoring within this fraction of the best are treated as ties, and the smallest one wins
+ARMA_SELECTION_TOLERANCE = 0.01
+
+# trailing days held out to compute the out-of-sample score
+ARMA_HOLDOUT_DAYS = 56
+
+# number of processes fitting orders in parallel, None uses every core
+ARMA_SEARCH_WORKERS = None
+
+# file caching scores per (order, data fingerprint) and the last selected order
+ARMA_CACHE_PATH = 'arma_order_cache.json'
+
+# rerun the grid search only when the last selection is at least this many days old
+ARMA_RESELECT_DAYS = 7
+
+# number of paths held in memory at once, rounded down to whole blocks of streaming.SIM_BLOCK_SIZE paths
+# only affects speed and memory, the sims are the same for any chunk size
+SIM_CHUNK_SIZE = 100000
+
+# if True, generate_predictions streams sims in chunks into a weekly average histogram
+# peak memory is then independent of NSIMS
+STREAM_SIMS = False
+
+# in streaming mode, also write every chunk of sims to the sims table
+STREAM_WRITE_SIMS = False
+
+# dtype of streamed sims, 'float32' halves the memory and storage of each chunk
+SIM_DTYPE = 'float64'
+
+# bin edges of the weekly average histogram, in passengers
+HIST_LOWER = 0
+HIST_UPPER = 5000000
+HIST_BIN_WIDTH = 500
+
+# local directory holding the weekly average histograms
+HIST_DIR = 'sims'
+
+# backend fitting the trend + seasonality + holiday component - 'prophet' or 'native' (NumPy least squares)
+FORECASTER = 'prophet'
+
+# hour at which the paper exchange replay assumes the previous weekday's TSA data is posted
+PAPER_POST_HOUR = 9
+
+# if set, main, generate_predictions and trader_main are profiled and results written under this directory
+# also enabled with python main.py --profile [DIR]
+PROFILE_DIR = None
+
+# directory used by --profile when none is given
+PROFILE_DEFAULT_DIR = 'profiles'
+
+# seconds between stack samples of the sampling profiler
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# frames kept per allocation traceback
+PROFILE_TRACEBACK_DEPTH = 10
+
+# number of functions and allocation sites listed in the text reports
+PROFILE_TOP_N = 30
+
+# master seed for the simulations, None draws fresh entropy (printed with each run)
+SIM_SEED = None
+
+# number of independently seeded shards the sims are split into, simulated over a process pool when > 1
+# results depend only on SIM_SEED and SIM_SHARDS, not on how many workers run them or on SIM_CHUNK_SIZE
+SIM_SHARDS = 1
+
+# number of worker processes for sharded simulation, None uses every core
+SIM_WORKERS = None
+
+# sims are kept in full for cutoffs up to this many days before the newest one
+SIMS_RETENTION_DAYS = 28
+
+# if True, expired sims are summarized into weekly average quantiles before being dropped
+SIMS_SUMMARIZE_EXPIRED = True
+
+# quantile levels kept in the summary of an expired run
+SIMS_SUMMARY_QUANTILES = [0.001] + [round(0.005 * i, 3) for i in range(1, 200)] + [0.999]
+
+# if True, a new TSA post is first priced by conditioning the previous run of the week on the new days,
+# and the full refit + simulation runs in the background
+FAST_UPDATE = False
+
+# number of upcoming weekly events simulated from each fit, the current event's week first
+# every run stores one weekly average distribution per event, so later weeks can be quoted before their Monday
+FORECAST_WEEKS = 2
+
+# local directory holding each cutoff's pipeline checkpoints (data, fitted models, sims, write status),
+# so a failed run resumes from its first incomplete stage
+CHECKPOINT_DIR = 'checkpoints'
+
+# checkpoints of cutoffs older than this many days are deleted
+CHECKPOINT_RETENTION_DAYS = 7
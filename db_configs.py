@@ -13,6 +13,9 @@ DB_USER = ''
 # db password set on creation - enter your own
 DB_PASSWORD = ''
 
+# rows per round trip when streaming large query results through a server-side cursor
+DB_FETCH_SIZE = 10000
+
 # insert row command for initially populating time series table
 INSERT_ROW = """
     INSERT INTO {table} (id, date, passengers)
@@ -30,18 +33,163 @@ QUERY_ALL_SCHEMA = """
 SELECT * FROM {schema}.{table}
 """
 
-# create a sims table with columns for each day
-CREATE_TABLE = """
-CREATE TABLE IF NOT EXISTS {table} (M float, T float, W float, TH float, F float, SA float, SU float)
+# schema, tables and index holding all simulation runs
+SIMS_SCHEMA = 'sims'
+SIMS_TABLE = 'all_sims'
+SIMS_RUNS_TABLE = 'runs'
+SIMS_SUMMARY_TABLE = 'run_summaries'
+SIMS_RUNS_INDEX = 'runs_cutoff_created_idx'
+SIMS_RUN_ID_INDEX = 'all_sims_run_id_idx'
+
+# create the sims schema
+CREATE_SCHEMA = """
+CREATE SCHEMA IF NOT EXISTS {schema}
+"""
+
+# one table for every sim of every run, partitioned by cutoff date so old days can be dropped cheaply
+# each sim has one row per simulated week, week_ahead 0 being the current event's week
+CREATE_SIMS_TABLE = """
+CREATE TABLE IF NOT EXISTS {schema}.{table} (
+    run_id uuid NOT NULL,
+    cutoff_date date NOT NULL,
+    sim_id integer NOT NULL,
+    week_ahead smallint NOT NULL DEFAULT 0,
+    M float, T float, W float, TH float, F float, SA float, SU float
+) PARTITION BY LIST (cutoff_date)
+"""
+
+# index to read a single run out of a partition
+CREATE_SIMS_RUN_ID_INDEX = """
+CREATE INDEX IF NOT EXISTS {index} ON {schema}.{table} (run_id)
+"""
+
+# partition holding the sims of one cutoff date
+CREATE_SIMS_PARTITION = """
+CREATE TABLE IF NOT EXISTS {schema}.{partition} PARTITION OF {schema}.{table} FOR VALUES IN (%s)
+"""
+
+# one row per simulation run with its metadata
+# status is 'writing' until every sim is inserted, readers only see 'complete' runs
+CREATE_SIMS_RUNS = """
+CREATE TABLE IF NOT EXISTS {schema}.{table} (
+    run_id uuid PRIMARY KEY,
+    cutoff_date date NOT NULL,
+    created_at timestamp NOT NULL DEFAULT now(),
+    nsims integer,
+    seed text,
+    model_version text,
+    status text NOT NULL DEFAULT 'writing',
+    weeks smallint NOT NULL DEFAULT 1,
+    shards smallint NOT NULL DEFAULT 1,
+    block_size integer
+)
+"""
+
+# index for fetching the latest run of a cutoff date
+CREATE_SIMS_RUNS_INDEX = """
+CREATE INDEX IF NOT EXISTS {index} ON {schema}.{table} (cutoff_date DESC, created_at DESC)
+"""
+
+# weekly average summary kept for runs whose sims were dropped by the retention policy
+CREATE_SIMS_SUMMARY = """
+CREATE TABLE IF NOT EXISTS {schema}.{table} (
+    run_id uuid PRIMARY KEY,
+    cutoff_date date NOT NULL,
+    nsims integer,
+    mean float,
+    std float,
+    quantile_levels float[],
+    quantiles float[]
+)
+"""
+
+# register a new run
+INSERT_RUN = """
+    INSERT INTO {schema}.{table} (run_id, cutoff_date, nsims, seed, model_version, weeks, shards, block_size)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# mark a run as fully written
+FINISH_RUN = """
+UPDATE {schema}.{table} SET status = 'complete' WHERE run_id = %s
 """
 
-# insert a sim into sims table
+# insert sims into the sims table
 INSERT_SIM = """
-    INSERT INTO {schema}.{table} (M, T, W, TH, F, SA, SU)
+    INSERT INTO {schema}.{table} (run_id, cutoff_date, sim_id, week_ahead, M, T, W, TH, F, SA, SU)
     VALUES %s
 """
 
-# change sims table to sims schema
-CHANGE_SCHEMA = """
-ALTER TABLE {table} SET SCHEMA {schema};
+# latest complete run for a cutoff date
+QUERY_LATEST_RUN = """
+SELECT run_id FROM {schema}.{table}
+WHERE cutoff_date = %s AND status = 'complete'
+ORDER BY created_at DESC
+LIMIT 1
+"""
+
+# weekly average of every sim in a run for one week, computed in the db so only one column comes back
+QUERY_RUN_WEEKLY_AVGS = """
+SELECT (M + T + W + TH + F + SA + SU) / 7 AS weekly_avg FROM {schema}.{table}
+WHERE cutoff_date = %s AND run_id = %s AND week_ahead = %s
+ORDER BY sim_id
+"""
+
+# partitions of the sims table
+QUERY_PARTITIONS = """
+SELECT c.relname FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+JOIN pg_namespace n ON n.oid = p.relnamespace
+WHERE n.nspname = %s AND p.relname = %s
+"""
+
+# tables in a schema, used to find the old one-table-per-day sims tables
+QUERY_SCHEMA_TABLES = """
+SELECT tablename FROM pg_tables WHERE schemaname = %s
+"""
+
+# summarize every run in a partition (or legacy table) before it is dropped
+# legacy tables have no run id, so one is derived from the table name
+# where - optional filter, so multi-week runs are summarized on their current week only
+INSERT_RUN_SUMMARIES = """
+INSERT INTO {schema}.{summary} (run_id, cutoff_date, nsims, mean, std, quantile_levels, quantiles)
+SELECT run_id, %s, count(*), avg(weekly_avg), stddev_pop(weekly_avg), %s::float[],
+       percentile_cont(%s::float[]) WITHIN GROUP (ORDER BY weekly_avg)
+FROM (SELECT {run_id} AS run_id, (M + T + W + TH + F + SA + SU) / 7 AS weekly_avg
+      FROM {schema}.{table} {where}) s
+GROUP BY run_id
+ON CONFLICT (run_id) DO NOTHING
+"""
+
+# drop a partition or legacy table
+DROP_TABLE = """
+DROP TABLE IF EXISTS {schema}.{table}
+"""
+
+# flag the runs of a dropped partition, keeping their metadata
+MARK_RUNS_DROPPED = """
+UPDATE {schema}.{table} SET status = 'dropped' WHERE cutoff_date = %s
+"""
+
+# latest complete run for an earlier cutoff whose simulated weeks still cover the new cutoff's current event,
+# used as the prior for a fast update
+# the second parameter is the Sunday the new cutoff's current event closes on
+# a run's first event closes on the first Sunday strictly after its cutoff (a Sunday cutoff's week is over,
+# so its first event is the following week), i.e. cutoff_date + 7 - isodow % 7, and its last event
+# 7 * (weeks - 1) days later; a Sunday-cutoff run therefore covers exactly the week after it
+QUERY_PREVIOUS_RUN = """
+SELECT run_id, cutoff_date, nsims, seed, model_version, weeks, shards, block_size FROM {schema}.{table}
+WHERE cutoff_date < %s
+  AND cutoff_date + (7 - extract(isodow from cutoff_date)::int %% 7) + 7 * (weeks - 1) >= %s
+  AND status = 'complete'
+ORDER BY cutoff_date DESC, created_at DESC
+LIMIT 1
+"""
+
+# every sim of a run, in sim order, each sim's weeks in order
+QUERY_RUN_SIMS = """
+SELECT M, T, W, TH, F, SA, SU FROM {schema}.{table}
+WHERE cutoff_date = %s AND run_id = %s
+ORDER BY sim_id, week_ahead
 """
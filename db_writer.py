@@ -1,3 +1,6 @@
+import re
+from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import psycopg2
 from psycopg2 import sql
@@ -7,6 +10,24 @@ import requests
 from bs4 import BeautifulSoup
 import config
 
+try:
+    import pyarrow as pa
+except ImportError: # only needed for AWS_RDB_CLIENT.stream_arrow
+    pa = None
+
+# numpy dtypes for common postgres type oids; columns of any other type are kept as python objects
+PG_DTYPES = {
+    16: np.bool_,            # boolean
+    20: np.int64,            # bigint
+    21: np.int16,            # smallint
+    23: np.int32,            # integer
+    700: np.float32,         # real
+    701: np.float64,         # double precision
+    1700: np.float64,        # numeric
+    1082: 'datetime64[D]',   # date
+    1114: 'datetime64[us]',  # timestamp
+}
+
 class AWS_RDB_CLIENT:
     # object that can query and write to the AWS db
     def __init__(self, host, port, dbname, user, password):
@@ -27,24 +48,90 @@ class AWS_RDB_CLIENT:
 
         self.cursor = self.conn.cursor()
 
+        # number of named cursors opened so far, to give each one a unique name
+        self.named_cursors = 0
+
     def write_sql(self, query, data_tuple):
         if data_tuple: # execute commands can contain date to be used in the query
             self.cursor.execute(query, data_tuple)
         else:
             self.cursor.execute(query)
 
-    def query_sql(self, query):
-        # return query result as df
-        self.cursor.execute(query)
-        df = pd.DataFrame(self.cursor.fetchall())
+    def query_sql(self, query, data_tuple=None):
+        # return query result as df, with the db column names
+        # data_tuple - optional parameters to be used in the query
+        # fetches everything at once, so meant for small results; use stream_sql or query_array for large ones
+        self.cursor.execute(query, data_tuple)
+        columns = [column.name for column in self.cursor.description]
+        df = pd.DataFrame(self.cursor.fetchall(), columns=columns)
         return df
 
+    def fetch_batches(self, query, data_tuple=None, fetch_size=None):
+        # run a query on a named (server-side) cursor and yield (description, rows) fetch_size rows at a time
+        # the result stays on the server, so only one batch is ever held client-side
+
+        fetch_size = fetch_size or db_configs.DB_FETCH_SIZE
+        self.named_cursors += 1
+        with self.conn.cursor(name='stream_' + str(self.named_cursors)) as cursor:
+            cursor.itersize = fetch_size
+            cursor.execute(query, data_tuple)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield cursor.description, rows
+
+    def stream_sql(self, query, data_tuple=None, fetch_size=None):
+        # yield query result in batches, each a dict of column name -> numpy array typed from the column's db type
+
+        for description, rows in self.fetch_batches(query, data_tuple, fetch_size):
+            yield batch_columns(description, rows)
+
+    def stream_arrow(self, query, data_tuple=None, fetch_size=None):
+        # same as stream_sql, but each batch is a pyarrow RecordBatch
+
+        if pa is None:
+            raise ImportError('pyarrow is required for AWS_RDB_CLIENT.stream_arrow')
+        for batch in self.stream_sql(query, data_tuple, fetch_size):
+            yield pa.RecordBatch.from_pydict(batch)
+
+    def query_array(self, query, data_tuple=None, dtype=np.float64, fetch_size=None, nrows=None):
+        # return a numeric query result as one 2d array, decoding each batch straight into it
+        # nrows - expected number of rows, if known, so the array is allocated once and filled in place
+
+        if nrows is not None:
+            out = None
+            done = 0
+            for _, rows in self.fetch_batches(query, data_tuple, fetch_size):
+                if out is None:
+                    out = np.empty((nrows, len(rows[0])), dtype=dtype)
+                out[done:done + len(rows)] = rows
+                done += len(rows)
+            return out[:done] if out is not None else np.empty((0, 0), dtype=dtype)
+
+        batches = [np.array(rows, dtype=dtype) for _, rows in self.fetch_batches(query, data_tuple, fetch_size)]
+        return np.concatenate(batches) if batches else np.empty((0, 0), dtype=dtype)
+
     def commit(self):
         # commit changes to db
         self.conn.commit()
 
 
 
+def batch_columns(description, rows):
+    # turn fetched rows into a dict of column name -> numpy array
+    # columns whose db type has no numpy equivalent, or that hold nulls, come back as object arrays
+
+    batch = {}
+    for column, values in zip(description, zip(*rows)):
+        dtype = PG_DTYPES.get(column.type_code)
+        try:
+            batch[column.name] = np.array(values, dtype=dtype if dtype is not None else object)
+        except (TypeError, ValueError):
+            batch[column.name] = np.array(values, dtype=object)
+    return batch
+
+
 def scrape_new(url):
     # scrape TSA data from website
 
@@ -67,61 +154,157 @@ def scrape_new(url):
 
     return df
 
-def construct_table_name(most_recent_cutoff):
-    # construct name of table which will store sims for a certain day
-    # most_recent_cutoff - the corresponding table will store sims using data up through this date
-
-    day = str(most_recent_cutoff.day)
-    if len(day) == 1:
-        day = '0' + day
-    month = config.MONTH_ABBREVS[most_recent_cutoff.month]
-    year = str(most_recent_cutoff.year)[-2:]
-
-    return year + month + day
-
-def create_preds_table(most_recent_date):
-    # create the table that will store the simulation results
+def construct_partition_name(most_recent_cutoff):
+    # name of the sims partition holding every run for a cutoff date, e.g. all_sims_20250713
+    return db_configs.SIMS_TABLE + '_' + most_recent_cutoff.strftime('%Y%m%d')
+
+def sims_identifiers(**tables):
+    # sql identifiers for the sims schema plus the given table names
+    ids = {'schema': sql.Identifier(db_configs.SIMS_SCHEMA)}
+    for key, name in tables.items():
+        ids[key] = sql.Identifier(name)
+    return ids
+
+def create_sims_store(client):
+    # create the partitioned sims table, the runs and summary tables and their indexes if needed
+
+    client.write_sql(sql.SQL(db_configs.CREATE_SCHEMA).format(**sims_identifiers()), ())
+    client.write_sql(sql.SQL(db_configs.CREATE_SIMS_TABLE).format(**sims_identifiers(table=db_configs.SIMS_TABLE)), ())
+    client.write_sql(sql.SQL(db_configs.CREATE_SIMS_RUN_ID_INDEX).format(
+        **sims_identifiers(table=db_configs.SIMS_TABLE, index=db_configs.SIMS_RUN_ID_INDEX)), ())
+    client.write_sql(sql.SQL(db_configs.CREATE_SIMS_RUNS).format(**sims_identifiers(table=db_configs.SIMS_RUNS_TABLE)), ())
+    client.write_sql(sql.SQL(db_configs.CREATE_SIMS_RUNS_INDEX).format(
+        **sims_identifiers(table=db_configs.SIMS_RUNS_TABLE, index=db_configs.SIMS_RUNS_INDEX)), ())
+    client.write_sql(sql.SQL(db_configs.CREATE_SIMS_SUMMARY).format(
+        **sims_identifiers(table=db_configs.SIMS_SUMMARY_TABLE)), ())
+
+def create_sims_run(most_recent_date, run_id, nsims, seed, model_version, weeks=1, shards=1, block_size=None):
+    # register a new simulation run, creating the store and the cutoff date's partition if needed
     # most_recent_date - same as most_recent_cutoff
+    # weeks - number of upcoming weeks simulated in each sim
+    # shards, block_size - how the seed was split into random streams (config.SIM_SHARDS and
+    #                      streaming.SIM_BLOCK_SIZE), stored with the seed so the run can be reproduced
+    # the run stays invisible to readers until finish_sims_run
 
-    name = construct_table_name(most_recent_date)
     client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
                             db_configs.DB_USER, db_configs.DB_PASSWORD)
-    
-    # execute sql command to create table
-    create = sql.SQL(db_configs.CREATE_TABLE).format(table=sql.Identifier(name))
-    client.write_sql(create, ())
-
-    try:
-        # put this table in the sims schema
-        change_schema = sql.SQL(db_configs.CHANGE_SCHEMA).format(table=sql.Identifier(name),
-                                                                schema=sql.Identifier('sims'))
-        client.write_sql(change_schema, ())
-    except:
-        client.commit()
+    create_sims_store(client)
 
-    client.commit()
+    cutoff_date = pd.Timestamp(most_recent_date).date()
+    partition = sql.SQL(db_configs.CREATE_SIMS_PARTITION).format(
+        **sims_identifiers(table=db_configs.SIMS_TABLE, partition=construct_partition_name(most_recent_date)))
+    client.write_sql(partition, (cutoff_date,))
 
+    insert_run = sql.SQL(db_configs.INSERT_RUN).format(**sims_identifiers(table=db_configs.SIMS_RUNS_TABLE))
+    client.write_sql(insert_run, (run_id, cutoff_date, nsims, str(seed), model_version, weeks, shards, block_size))
 
+    client.commit()
 
-def write_preds(preds, most_recent_date):
-    # populate table with simulation results
-    # preds - nsims x 7 array containing simulation results
-
-    name = construct_table_name(most_recent_date)
-
-    client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
-                            db_configs.DB_USER, db_configs.DB_PASSWORD)
+def write_preds(preds, most_recent_date, run_id, client=None, offset=0):
+    # populate the run's partition with simulation results
+    # preds - nsims x 7 array containing simulation results, or nsims x 7*weeks for multi-week runs
+    #         each sim is stored as one row per week
+    # run_id - run created by create_sims_run
+    # client - optional open client, so chunked writers can reuse one connection
+    # offset - sim_id of the first row, for runs written in chunks
+
+    if client is None:
+        client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
+                                db_configs.DB_USER, db_configs.DB_PASSWORD)
     
     # sql insert command
-    insert_pred = sql.SQL(db_configs.INSERT_SIM).format(table=sql.Identifier(name),
-                                                          schema=sql.Identifier('sims'))
-    rows = preds.tolist()
+    insert_pred = sql.SQL(db_configs.INSERT_SIM).format(**sims_identifiers(table=db_configs.SIMS_TABLE))
+    cutoff_date = pd.Timestamp(most_recent_date).date()
+    weeks = preds.shape[1] // 7
+    rows = [(run_id, cutoff_date, offset + i // weeks, i % weeks, *row)
+            for i, row in enumerate(preds.reshape(-1, 7).tolist())]
 
     # psycopg2 function to batch insert new rows
     execute_values(client.cursor, insert_pred, rows)
 
     client.commit()
 
+def finish_sims_run(run_id):
+    # mark a run as fully written, making it the latest run readers see for its cutoff date
+
+    client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
+                            db_configs.DB_USER, db_configs.DB_PASSWORD)
+    finish = sql.SQL(db_configs.FINISH_RUN).format(**sims_identifiers(table=db_configs.SIMS_RUNS_TABLE))
+    client.write_sql(finish, (run_id,))
+    client.commit()
+
+def get_latest_run(client, most_recent_date):
+    # run id of the latest complete run for a cutoff date, or None if there is none
+
+    query = sql.SQL(db_configs.QUERY_LATEST_RUN).format(**sims_identifiers(table=db_configs.SIMS_RUNS_TABLE))
+    runs = client.query_sql(query, (pd.Timestamp(most_recent_date).date(),))
+    if len(runs) == 0:
+        return None
+    return runs.iloc[0, 0]
+
+def get_previous_run(client, most_recent_date):
+    # latest complete run for an earlier cutoff whose simulated weeks cover the week of most_recent_date
+    # returns dict with run_id, cutoff_date, nsims, seed, model_version, weeks, shards and block_size, or None
+
+    most_recent_date = pd.Timestamp(most_recent_date)
+    # Sunday the current event closes on; a Sunday cutoff's current event is the following week
+    event_sunday = (most_recent_date + timedelta(days=7 - (most_recent_date.weekday() + 1) % 7)).date()
+    query = sql.SQL(db_configs.QUERY_PREVIOUS_RUN).format(**sims_identifiers(table=db_configs.SIMS_RUNS_TABLE))
+    runs = client.query_sql(query, (most_recent_date.date(), event_sunday))
+    if len(runs) == 0:
+        return None
+    return runs.iloc[0].to_dict()
+
+def read_run_sims(client, cutoff_date, run_id, nsims=None, weeks=1):
+    # every sim of a run as an nsims x 7*weeks array, streamed from the db in batches
+    # nsims - size of the run, if known, so the array is allocated once
+
+    query = sql.SQL(db_configs.QUERY_RUN_SIMS).format(**sims_identifiers(table=db_configs.SIMS_TABLE))
+    rows = client.query_array(query, (cutoff_date, run_id), nrows=nsims * weeks if nsims else None)
+    return rows.reshape(-1, 7 * weeks)
+
+def summarize_and_drop(client, table, cutoff_date, run_id, where=sql.SQL('')):
+    # keep a weekly average summary of every run in a sims table, then drop the table
+    # run_id - sql expression giving each row's run id
+    # where - optional sql filter on the rows summarized
+
+    if config.SIMS_SUMMARIZE_EXPIRED:
+        levels = list(config.SIMS_SUMMARY_QUANTILES)
+        summarize = sql.SQL(db_configs.INSERT_RUN_SUMMARIES).format(
+            run_id=run_id, where=where, **sims_identifiers(summary=db_configs.SIMS_SUMMARY_TABLE, table=table))
+        client.write_sql(summarize, (cutoff_date, levels, levels))
+
+    client.write_sql(sql.SQL(db_configs.DROP_TABLE).format(**sims_identifiers(table=table)), ())
+    mark = sql.SQL(db_configs.MARK_RUNS_DROPPED).format(**sims_identifiers(table=db_configs.SIMS_RUNS_TABLE))
+    client.write_sql(mark, (cutoff_date,))
+    client.commit()
+    print('SIMS EXPIRED:', table)
+
+def apply_sims_retention(most_recent_date):
+    # retention policy for the sims store
+    # partitions for cutoffs more than SIMS_RETENTION_DAYS before most_recent_date are summarized and dropped
+    # old one-table-per-day sims tables (e.g. sims."25JUL13") past retention are handled the same way
+
+    oldest_kept = pd.Timestamp(most_recent_date).date() - timedelta(days=config.SIMS_RETENTION_DAYS)
+    client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
+                            db_configs.DB_USER, db_configs.DB_PASSWORD)
+
+    partitions = client.query_sql(db_configs.QUERY_PARTITIONS, (db_configs.SIMS_SCHEMA, db_configs.SIMS_TABLE))
+    for name in (partitions.iloc[:, 0] if len(partitions) else []):
+        cutoff_date = datetime.strptime(name[len(db_configs.SIMS_TABLE) + 1:], '%Y%m%d').date()
+        if cutoff_date < oldest_kept:
+            summarize_and_drop(client, name, cutoff_date, sql.Identifier('run_id'), sql.SQL('WHERE week_ahead = 0'))
+
+    tables = client.query_sql(db_configs.QUERY_SCHEMA_TABLES, (db_configs.SIMS_SCHEMA,))
+    for name in (tables.iloc[:, 0] if len(tables) else []):
+        if not re.fullmatch(r'\d{2}[A-Z]{3}\d{2}', name):
+            continue
+        cutoff_date = datetime.strptime(name, '%y%b%d').date()
+        if cutoff_date < oldest_kept:
+            # legacy tables have no run id, derive a stable one from the table name
+            legacy_run_id = sql.SQL('md5({})::uuid').format(sql.Literal(name))
+            summarize_and_drop(client, name, cutoff_date, legacy_run_id)
+
 def update_db(url):
     # update time series table with new entries
 
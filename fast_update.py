@@ -0,0 +1,77 @@
+import numpy as np
+import uuid
+
+import db_configs
+from db_writer import AWS_RDB_CLIENT, get_previous_run, read_run_sims, create_sims_run, write_preds, finish_sims_run
+from helpers import get_all_data, get_previous_sunday, to_datetime
+from profiling import profiled
+
+
+def condition_paths(paths, observed_cols, observed_values):
+    # condition simulated paths on newly observed days without resimulating
+    # paths - nsims x 7*weeks array of paths, jointly Gaussian over their simulated days
+    # observed_cols - columns (0 = Monday of the first week) that have now been observed
+    # observed_values - the observed passenger values for those columns
+    #
+    # for a Gaussian vector, x2 + S21 S11^-1 (a - x1) is an exact draw from x2 | x1 = a
+    # (Matheron's rule), so shifting every prior path gives paths from the conditional distribution
+    # S11 and S21 are estimated from the paths themselves
+
+    observed_cols = np.asarray(observed_cols)
+    varying = np.flatnonzero(paths.std(axis=0) > 0) # days that were still simulated in the prior run
+    rest = np.setdiff1d(varying, observed_cols)
+
+    conditioned = paths.copy()
+    if len(rest) > 0:
+        cov = np.cov(paths, rowvar=False)
+        s11 = cov[np.ix_(observed_cols, observed_cols)]
+        s21 = cov[np.ix_(rest, observed_cols)]
+        gain = np.linalg.solve(s11, s21.T).T # S21 S11^-1
+        conditioned[:, rest] += (observed_values - paths[:, observed_cols]) @ gain.T
+    conditioned[:, observed_cols] = observed_values
+    return conditioned
+
+@profiled('fast_update_predictions')
+def fast_update_predictions():
+    # produce the new cutoff's sims from a previous run covering this week and the newly posted days
+    # no refit and no simulation, so fair values are available right after the TSA post
+    # weeks of the prior run that are now over are dropped, so a multi-week run also covers the week rollover
+    # returns nsims x weeks array of weekly averages, or None when there is no usable prior run
+
+    all_data = get_all_data()
+    most_recent_datetime = to_datetime(all_data.iloc[-1, 0])
+
+    client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
+                            db_configs.DB_USER, db_configs.DB_PASSWORD)
+    prior = get_previous_run(client, most_recent_datetime)
+    if prior is None:
+        print('FAST UPDATE: NO PRIOR RUN COVERING THIS WEEK')
+        return None
+
+    # the days posted since the prior run's cutoff
+    prior_cutoff = to_datetime(prior['cutoff_date'])
+    new_days = all_data[all_data.date > prior_cutoff]
+    if len(new_days) != (most_recent_datetime - prior_cutoff).days:
+        print('FAST UPDATE: MISSING DAYS SINCE', prior_cutoff)
+        return None
+    prior_week_start = get_previous_sunday(prior_cutoff)
+    observed_cols = np.array([(date - prior_week_start).days - 1 for date in new_days.date])
+    observed_values = np.array(new_days.passengers, dtype=np.float64)
+
+    # weeks of the prior run that end before the new cutoff's current week
+    weeks_done = (get_previous_sunday(most_recent_datetime) - prior_week_start).days // 7
+    weeks = int(prior['weeks'])
+
+    paths = read_run_sims(client, prior['cutoff_date'], prior['run_id'], prior['nsims'], weeks)
+    client.commit() # end the read transaction, which would otherwise block creating the new partition
+    print('FAST UPDATE FROM', prior_cutoff, 'RUN', prior['run_id'], 'DAYS', observed_cols)
+    preds = condition_paths(paths, observed_cols, observed_values)[:, 7 * weeks_done:]
+
+    # store as a normal run so the trader picks it up; the full regeneration supersedes it later
+    run_id = str(uuid.uuid4())
+    create_sims_run(most_recent_datetime, run_id, len(preds), prior['seed'], prior['model_version'] + '+conditioned',
+                    weeks - weeks_done, int(prior['shards']), int(prior['block_size']))
+    write_preds(preds, most_recent_datetime, run_id)
+    finish_sims_run(run_id)
+
+    return preds.reshape(len(preds), -1, 7).mean(axis=2)
@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+import holidays
+from scipy.stats import norm
+
+
+class NativeForecaster:
+    # drop-in replacement for the Prophet model used in pred_generator
+    # piecewise-linear trend + Fourier seasonalities + holiday indicators, solved as one ridge regression
+    # exposes the parts of the Prophet interface the pipeline uses:
+    # add_seasonality, add_country_holidays, fit, make_future_dataframe, predict
+    def __init__(self, interval_width=0.95, changepoint_prior_scale=0.05, n_changepoints=25,
+                 changepoint_range=0.8, seasonality_prior_scale=10.0, holidays_prior_scale=10.0):
+        self.interval_width = interval_width
+        self.changepoint_prior_scale = changepoint_prior_scale
+        self.n_changepoints = n_changepoints
+        self.changepoint_range = changepoint_range
+        self.seasonality_prior_scale = seasonality_prior_scale
+        self.holidays_prior_scale = holidays_prior_scale
+
+        # same defaults Prophet picks for multi-year daily data
+        self.seasonalities = {'yearly': (365.25, 10), 'weekly': (7, 3)}
+        self.country_holidays = None
+        self.holiday_names = []
+
+        # seasonal + holiday columns for a contiguous block of days starting at _cache_start
+        # fits and predictions on later days only compute the rows that are missing
+        self._cache_start = None
+        self._cache = np.empty((0, 0))
+
+        self.history_dates = None
+        self.params = None
+
+    def add_seasonality(self, name, period, fourier_order):
+        self.seasonalities[name] = (period, fourier_order)
+        self._reset_cache()
+        return self
+
+    def add_country_holidays(self, country_name):
+        self.country_holidays = country_name
+        self._reset_cache()
+        return self
+
+    def _reset_cache(self):
+        self._cache_start = None
+        self._cache = np.empty((0, 0))
+
+    def _holiday_calendar(self, dates):
+        # map date -> holiday name for every year spanned by dates
+        years = range(dates.min().year, dates.max().year + 1)
+        return holidays.country_holidays(self.country_holidays, years=years)
+
+    def _build_rows(self, dates):
+        # seasonal and holiday features for the given dates
+
+        t = dates.values.astype('datetime64[D]').astype(np.float64) # days since epoch, as in Prophet
+        columns = []
+        for period, order in self.seasonalities.values():
+            for i in range(1, order + 1):
+                x = 2 * np.pi * i * t / period
+                columns.append(np.sin(x))
+                columns.append(np.cos(x))
+
+        if self.holiday_names:
+            calendar = self._holiday_calendar(dates)
+            names = np.array([calendar.get(d, '') for d in dates.date])
+            for name in self.holiday_names:
+                columns.append((names == name).astype(np.float64))
+
+        return np.column_stack(columns)
+
+    def _seasonal_features(self, dates):
+        # rows of the cached design block for dates, extending the block first if needed
+
+        days = dates.values.astype('datetime64[D]')
+        first, last = days.min(), days.max()
+        if self._cache_start is None or first < self._cache_start:
+            # (re)start the block at the earliest requested day
+            self._cache_start = first
+            self._cache = np.empty((0, 0))
+
+        missing_from = self._cache_start + len(self._cache)
+        if last >= missing_from:
+            new_days = pd.DatetimeIndex(np.arange(missing_from, last + 1))
+            new_rows = self._build_rows(new_days)
+            self._cache = new_rows if len(self._cache) == 0 else np.vstack((self._cache, new_rows))
+
+        return self._cache[(days - self._cache_start).astype(np.int64)]
+
+    def _trend_features(self, dates):
+        # intercept, slope, and a hinge (t - s)+ at each changepoint, with t scaled to [0, 1] over history
+
+        t = (dates - self.start).days.values / self.t_scale
+        hinges = np.maximum(t[:, None] - self.changepoints_t[None, :], 0)
+        return np.column_stack((np.ones(len(t)), t, hinges))
+
+    def _design(self, dates):
+        return np.hstack((self._trend_features(dates), self._seasonal_features(dates)))
+
+    def fit(self, df):
+        # fit on a df with columns ds and y
+
+        history = df[['ds', 'y']].dropna().sort_values('ds')
+        dates = pd.DatetimeIndex(history['ds'])
+        y = history['y'].values.astype(np.float64)
+        self.history_dates = history['ds'].reset_index(drop=True)
+
+        # holiday columns are the holidays that occur in the training data
+        if self.country_holidays is not None:
+            calendar = self._holiday_calendar(dates)
+            names = sorted({calendar.get(d) for d in dates.date if d in calendar})
+            if names != self.holiday_names:
+                self.holiday_names = names
+                self._reset_cache()
+
+        # time and scale setup mirroring Prophet
+        self.start = dates.min()
+        self.t_scale = max((dates.max() - self.start).days, 1)
+        self.y_scale = np.abs(y).max()
+        n_hist = int(np.floor(len(dates) * self.changepoint_range))
+        cp_idx = np.linspace(0, n_hist - 1, self.n_changepoints + 1).round().astype(int)[1:]
+        self.changepoints_t = (dates[cp_idx] - self.start).days.values / self.t_scale
+
+        X = self._design(dates)
+        y_scaled = y / self.y_scale
+
+        # Gaussian prior on each coefficient group; intercept and slope are left unpenalized
+        n_cp = len(self.changepoints_t)
+        n_seasonal = sum(2 * order for _, order in self.seasonalities.values())
+        prior_scales = np.concatenate((
+            [np.inf, np.inf],
+            np.full(n_cp, self.changepoint_prior_scale),
+            np.full(n_seasonal, self.seasonality_prior_scale),
+            np.full(len(self.holiday_names), self.holidays_prior_scale),
+        ))
+
+        # MAP estimate is ridge with penalty sigma^2 / prior_scale^2, so solve once for sigma and again
+        sigma2 = 1.0
+        for _ in range(2):
+            beta = self._ridge(X, y_scaled, sigma2 / np.square(prior_scales))
+            resid = y_scaled - X @ beta
+            sigma2 = np.mean(np.square(resid))
+
+        self.params = beta
+        self.sigma = np.sqrt(sigma2) * self.y_scale
+        return self
+
+    @staticmethod
+    def _ridge(X, y, penalties):
+        # solve min ||y - X b||^2 + sum(penalties * b^2) via the normal equations
+        A = X.T @ X
+        A[np.diag_indices_from(A)] += penalties
+        return np.linalg.solve(A, X.T @ y)
+
+    def make_future_dataframe(self, periods, include_history=True):
+        # same output as Prophet.make_future_dataframe for daily data
+
+        if self.history_dates is None:
+            raise Exception('Model has not been fit.')
+        last_date = self.history_dates.max()
+        future = pd.date_range(last_date + pd.Timedelta(days=1), periods=periods, freq='D')
+        if include_history:
+            future = np.concatenate((np.array(self.history_dates), future))
+        return pd.DataFrame({'ds': future})
+
+    def predict(self, future):
+        # return df with ds, trend, yhat, yhat_lower, yhat_upper like Prophet.predict
+        # the interval only reflects observation noise, not trend uncertainty
+
+        dates = pd.DatetimeIndex(future['ds'])
+        X = self._design(dates)
+        n_trend = 2 + len(self.changepoints_t)
+        trend = X[:, :n_trend] @ self.params[:n_trend] * self.y_scale
+        yhat = X @ self.params * self.y_scale
+        width = norm.ppf(0.5 + self.interval_width / 2) * self.sigma
+
+        return pd.DataFrame({'ds': dates, 'trend': trend, 'yhat': yhat,
+                             'yhat_lower': yhat - width, 'yhat_upper': yhat + width})
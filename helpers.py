@@ -84,11 +84,7 @@ def get_all_data():
     
     # get all data as df
     query = sql.SQL(db_configs.QUERY_ALL).format(table=sql.Identifier('all_data'))
-    all_data = client.query_sql(query)
-    
-    # get correct columns
-    all_data.drop(columns=[0], axis=1, inplace=True)
-    all_data.rename(columns={1:'date', 2:'passengers'}, inplace=True)
+    all_data = client.query_sql(query)[['date', 'passengers']]
     
     # sort by date and convert date to datetime
     all_data = all_data.sort_values('date').reset_index(drop=True)
@@ -1,11 +1,19 @@
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
 from helpers import get_most_recent_date, is_uptodate
-from api_helpers import construct_event_ticker
-from trader import trader_main, get_order_ids, cancel_orders
+from trader import trader_main, get_order_ids, cancel_orders, event_tickers
 from db_writer import update_db
 from pred_generator import generate_predictions
+from fast_update import fast_update_predictions
+from pipeline import pipeline_pending
+from api_helpers import construct_file_name
+from profiling import profiled
 import config
 
 
+@profiled('main')
 def main():
     # highest level trading and updating logic
 
@@ -14,7 +22,12 @@ def main():
 
     print('UP TO DATE:', trade, '\n')
 
-    if trade or config.BYPASS_UPTODATE:
+    if trade and pipeline_pending(construct_file_name(get_most_recent_date())):
+        # an earlier run scraped this cutoff but did not finish its simulations, resume it from its checkpoints
+        print('RESUMING PIPELINE')
+        generate_predictions(config.NSIMS)
+
+    elif trade or config.BYPASS_UPTODATE:
         # if is up to date or the up to date override is set, place orders
         trader_main()
 
@@ -22,22 +35,36 @@ def main():
         # 
         most_recent_date = get_most_recent_date()
        
-        # cancel all existing orders
-        event_ticker = construct_event_ticker(most_recent_date)
-        order_ids = get_order_ids(event_ticker)
-        cancel_orders(order_ids)
-
-        # scrape TSA website for any new data
-        update_db(config.SCRAPE_URL)
+        # cancel all existing orders and scrape TSA website for any new data
+        # the two are independent, so they overlap
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            scrape = executor.submit(update_db, config.SCRAPE_URL)
+            for event_ticker in event_tickers(most_recent_date):
+                order_ids = get_order_ids(event_ticker)
+                cancel_orders(order_ids)
+            scrape.result()
 
         # including new data, redetermine whether it is up to date
         trade = is_uptodate()
 
         if trade:
-            # if so, generate simulations containing the update
-            generate_predictions(config.NSIMS)
+            if config.FAST_UPDATE and fast_update_predictions() is not None:
+                # quote right away off the previous run conditioned on the new data,
+                # while the full refit and simulation run in the background and replace it once written
+                regenerate = multiprocessing.Process(target=generate_predictions, args=(config.NSIMS,))
+                regenerate.start()
+                trader_main()
+            else:
+                # if so, generate simulations containing the update
+                generate_predictions(config.NSIMS)
     
          
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', nargs='?', const=config.PROFILE_DEFAULT_DIR, default=config.PROFILE_DIR,
+                        metavar='DIR', help='profile CPU and memory of each stage, writing results under DIR')
+    args = parser.parse_args()
+    config.PROFILE_DIR = args.profile
+
     main()
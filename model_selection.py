@@ -0,0 +1,193 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from statsmodels.tsa.arima.model import ARIMA
+
+import config
+
+
+def order_grid(p_values, d_values, q_values):
+    # return every (p, d, q) combination to evaluate, skipping the empty (0, 0, 0) model
+
+    grid = []
+    for p in p_values:
+        for d in d_values:
+            for q in q_values:
+                if p == 0 and d == 0 and q == 0:
+                    continue
+                grid.append((p, d, q))
+    return grid
+
+def data_fingerprint(arma_df, holdout_days, horizon):
+    # hash the error series together with the scoring setup
+    # two calls with the same fingerprint will produce identical scores for a given order
+
+    digest = hashlib.sha256()
+    digest.update(np.asarray(arma_df.index.values, dtype='datetime64[ns]').tobytes())
+    digest.update(np.asarray(arma_df['error'].values, dtype=np.float64).tobytes())
+    digest.update(str((holdout_days, horizon)).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def cache_key(fingerprint, order):
+    # key under which the scores of one order on one dataset are cached
+    return fingerprint + ':' + ','.join(str(x) for x in order)
+
+def load_cache(path):
+    # read cached scores from disk, starting fresh if the file is missing or unreadable
+
+    if not os.path.exists(path):
+        return {'scores': {}, 'selected': None}
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {'scores': {}, 'selected': None}
+    cache.setdefault('scores', {})
+    cache.setdefault('selected', None)
+    return cache
+
+def save_cache(cache, path):
+    # write to a temp file first so a crash mid-write cannot corrupt the cache
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def score_order(errors, order, holdout_days, horizon):
+    # fit one ARIMA order on the training part of the error series and score it
+    # errors - pd.Series of Prophet errors indexed by date
+    # holdout_days - number of trailing days held out for the out-of-sample score
+    # horizon - forecast length from each origin, i.e. the longest we ever simulate (see arma_horizon)
+    # returns dict with aic, bic and oos_rmse (None if the fit failed)
+
+    train = errors.iloc[:-holdout_days]
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            train_fit = ARIMA(train, order=order, freq='D').fit()
+
+            # reuse the training parameters over the full series so the holdout is never fit on
+            full_fit = train_fit.apply(errors)
+
+            # forecast `horizon` days ahead from a new origin each week of the holdout
+            sq_errors = []
+            n = len(errors)
+            for origin in range(n - holdout_days, n, horizon):
+                end = min(origin + horizon, n) - 1
+                pred = full_fit.get_prediction(start=origin, end=end, dynamic=True).predicted_mean
+                sq_errors.extend(np.square(np.asarray(pred) - errors.iloc[origin:end + 1].values))
+
+        return {'aic': float(train_fit.aic), 'bic': float(train_fit.bic),
+                'oos_rmse': float(np.sqrt(np.mean(sq_errors)))}
+    except Exception as e:
+        return {'aic': None, 'bic': None, 'oos_rmse': None, 'error': repr(e)}
+
+def _score_order_task(args):
+    # process pool entry point, must be top level to be picklable
+    return score_order(*args)
+
+def search_orders(arma_df, grid, holdout_days=56, horizon=7, workers=None, cache_path=None):
+    # evaluate every order in the grid over a process pool and return scores keyed by order
+    # orders already scored on identical data are read from the cache instead of refit
+
+    fingerprint = data_fingerprint(arma_df, holdout_days, horizon)
+    cache = load_cache(cache_path) if cache_path else {'scores': {}, 'selected': None}
+
+    scores = {}
+    todo = []
+    for order in grid:
+        cached = cache['scores'].get(cache_key(fingerprint, order))
+        if cached is not None:
+            scores[order] = cached
+        else:
+            todo.append(order)
+    print('ARMA ORDERS CACHED:', len(scores), 'TO FIT:', len(todo))
+
+    if todo:
+        errors = arma_df['error']
+        tasks = [(errors, order, holdout_days, horizon) for order in todo]
+        if workers == 1:
+            results = list(map(_score_order_task, tasks))
+        else:
+            # workers start from a forkserver, since the pipeline runs other stages on threads meanwhile
+            # and forking a threaded process can deadlock the child
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context('forkserver')) as executor:
+                results = list(executor.map(_score_order_task, tasks))
+
+        for order, result in zip(todo, results):
+            scores[order] = result
+            cache['scores'][cache_key(fingerprint, order)] = result
+
+        if cache_path:
+            save_cache(cache, cache_path)
+
+    return scores
+
+def pick_order(scores, criterion='oos_rmse', tolerance=0.0):
+    # pick the best order by criterion
+    # any order scoring within `tolerance` (relative) of the best is considered as good,
+    # and among those the smallest model wins since it is faster to fit and simulate
+
+    valid = {order: s[criterion] for order, s in scores.items() if s.get(criterion) is not None}
+    if not valid:
+        raise ValueError('no ARMA order could be fit')
+
+    best = min(valid.values())
+    threshold = best + abs(best) * tolerance
+    candidates = [order for order, score in valid.items() if score <= threshold]
+    return min(candidates, key=lambda order: (sum(order), valid[order]))
+
+def arma_horizon():
+    # days forecast from each holdout origin, the longest we ever simulate from a fit:
+    # a Sunday cutoff simulates all FORECAST_WEEKS weeks in full
+    return 7 * config.FORECAST_WEEKS
+
+def selection_settings():
+    # config the selected order depends on, stored with it so a change of settings forces a new search
+    # lists rather than tuples, so the settings compare equal after a round trip through the json cache
+
+    return {'select': config.SELECT_ARMA_ORDER, 'forecaster': config.FORECASTER,
+            'p_grid': list(config.ARMA_P_GRID), 'd_grid': list(config.ARMA_D_GRID),
+            'q_grid': list(config.ARMA_Q_GRID), 'criterion': config.ARMA_SELECTION_CRITERION,
+            'tolerance': config.ARMA_SELECTION_TOLERANCE, 'holdout_days': config.ARMA_HOLDOUT_DAYS,
+            'horizon': arma_horizon()}
+
+def select_arma_order(arma_df, most_recent_date):
+    # return the ARMA order generate_predictions should use
+    # the grid search is rerun at most every ARMA_RESELECT_DAYS days, otherwise the last winner is reused,
+    # as long as it was selected under the current settings
+
+    if not config.SELECT_ARMA_ORDER:
+        return tuple(config.ARMA_ORDER)
+
+    cache = load_cache(config.ARMA_CACHE_PATH)
+    selected = cache['selected']
+    if selected is not None and selected.get('settings') != selection_settings():
+        print('ARMA SELECTION SETTINGS CHANGED, RESELECTING')
+    elif selected is not None:
+        selected_on = datetime.strptime(selected['date'], '%Y-%m-%d')
+        if 0 <= (most_recent_date - selected_on).days < config.ARMA_RESELECT_DAYS:
+            print('REUSING ARMA ORDER:', tuple(selected['order']))
+            return tuple(selected['order'])
+
+    grid = order_grid(config.ARMA_P_GRID, config.ARMA_D_GRID, config.ARMA_Q_GRID)
+    scores = search_orders(arma_df, grid, config.ARMA_HOLDOUT_DAYS, arma_horizon(),
+                           config.ARMA_SEARCH_WORKERS, config.ARMA_CACHE_PATH)
+    order = pick_order(scores, config.ARMA_SELECTION_CRITERION, config.ARMA_SELECTION_TOLERANCE)
+    print('SELECTED ARMA ORDER:', order, scores[order])
+
+    # remember the winner so the following days can skip the search
+    cache = load_cache(config.ARMA_CACHE_PATH)
+    cache['selected'] = {'order': list(order), 'date': most_recent_date.strftime('%Y-%m-%d'),
+                         'settings': selection_settings()}
+    save_cache(cache, config.ARMA_CACHE_PATH)
+
+    return order
@@ -0,0 +1,371 @@
+import bisect
+import json
+import itertools
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import config
+import api_helpers
+from helpers import get_next_sunday
+from trader import requote_events, send_orders
+
+# Recorded order books are JSON lines, one market per line, sorted by ts.
+# Lines sharing a ts form one snapshot of the event's books:
+# {"ts": "2025-07-08T09:30:00", "ticker": "KXTSAW-25JUL13-B2600000", "event_ticker": "KXTSAW-25JUL13",
+#  "floor_strike": 2600000, "yes_bid": 44, "yes_bid_size": 250, "yes_ask": 47, "yes_ask_size": 300,
+#  "trades": [{"taker_side": "no", "yes_price": 44, "count": 120}]}
+# trades are optional and hold the prints since the previous snapshot of that market.
+# taker_side 'no' means the taker sold yes, so it hits resting yes bids.
+
+
+class PaperExchange:
+    # local matching engine that answers the same calls as the Kalshi API
+    # our resting orders fill by price-time priority against the recorded books and trades
+    # latency - seconds between sending an order (or cancel) and the exchange acting on it
+    def __init__(self, latency=0.0):
+        self.latency = timedelta(seconds=latency)
+        self.now = None
+        self.markets = {} # ticker -> latest recorded market
+        self.orders = {} # order_id -> order, including pending and finished ones
+        self._open = {} # order_id -> order, only the resting ones, so matching never scans finished orders
+        self.positions = {} # ticker -> position, cost of the open side in cents, realized pnl in cents
+        self.settled_pnl = {} # ticker -> realized pnl in cents, for markets whose event has settled
+        self.fills = []
+        self.settled = {} # event_ticker -> realized weekly average
+        self._seq = itertools.count() # arrival sequence for time priority
+
+    # --- Kalshi API surface ---
+
+    def call_api(self, method, path, params={}):
+        # route a call_api request, returning the response body as text like the real API
+
+        if method == 'GET' and path == config.MARKETS_PATH:
+            markets = [self._market_view(m) for m in self.markets.values()
+                       if m['event_ticker'] == params.get('event_ticker')]
+            return json.dumps({'markets': markets})
+
+        if method == 'GET' and path == config.POSITIONS_PATH:
+            event_ticker = params.get('event_ticker', '')
+            positions = [{'ticker': ticker, 'position': p['position'],
+                          'market_exposure': int(round(p['cost'])), 'realized_pnl': int(round(p['realized']))}
+                         for ticker, p in self.positions.items() if ticker.startswith(event_ticker)]
+            return json.dumps({'market_positions': positions})
+
+        if method == 'GET' and path == config.ORDERS_PATH:
+            event_ticker = params.get('event_ticker', '')
+            status = params.get('status')
+            candidates = self._open if status == 'resting' else self.orders
+            orders = [self._order_view(o) for o in candidates.values()
+                      if o['ticker'].startswith(event_ticker) and (status is None or o['status'] == status)]
+            return json.dumps({'orders': orders})
+
+        if method == 'POST' and path == config.ORDERS_PATH:
+            return json.dumps({'order': self._order_view(self._new_order(params))})
+
+        if method == 'DELETE' and path.startswith(config.ORDERS_PATH + '/'):
+            order = self.orders[path[len(config.ORDERS_PATH) + 1:]]
+            order['cancel_at'] = self.now + self.latency
+            self._process_pending()
+            return json.dumps({'order': self._order_view(order)})
+
+        raise ValueError('paper exchange does not support ' + method + ' ' + path)
+
+    def _market_view(self, market):
+        return {key: market[key] for key in ('ticker', 'event_ticker', 'floor_strike', 'yes_bid', 'yes_ask')}
+
+    def _order_view(self, order):
+        view = {key: order[key] for key in ('order_id', 'client_order_id', 'ticker', 'side', 'action', 'status')}
+        view[order['side'] + '_price'] = order['price']
+        view['remaining_count'] = order['remaining']
+        return view
+
+    def _new_order(self, params):
+        order = {
+            'order_id': str(uuid.uuid4()),
+            'client_order_id': params.get('client_order_id'),
+            'ticker': params['ticker'],
+            'side': params['side'],
+            'action': params['action'],
+            'price': params[params['side'] + '_price'],
+            'remaining': params['count'],
+            'status': 'resting',
+            'seq': next(self._seq),
+            'active_at': self.now + self.latency, # invisible to the book until then
+            'cancel_at': None,
+            'queue_ahead': None,
+        }
+        self.orders[order['order_id']] = order
+        self._open[order['order_id']] = order
+        self._process_pending()
+        return order
+
+    # --- replay clock and matching ---
+
+    def advance(self, ts):
+        # move the exchange clock forward, activating and cancelling orders whose latency has elapsed
+        self.now = ts
+        self._process_pending()
+
+    def update_book(self, market):
+        # apply one recorded market snapshot and match our resting orders against it
+
+        previous = self.markets.get(market['ticker'])
+        self.markets[market['ticker']] = market
+        for order in self._resting(market['ticker']):
+            # size displayed at our price is ahead of us, and can only shrink while we wait
+            level_size = self._level_size(order, market)
+            if level_size is not None:
+                order['queue_ahead'] = min(order['queue_ahead'], level_size)
+
+        self._match_crossed(market, previous)
+        for trade in market.get('trades', []):
+            self._match_trade(market['ticker'], trade)
+
+    def _process_pending(self):
+        for order in list(self._open.values()):
+            if order['cancel_at'] is not None and order['cancel_at'] <= self.now:
+                self._close(order, 'canceled')
+            elif order['queue_ahead'] is None and order['active_at'] <= self.now:
+                self._activate(order)
+
+    def _activate(self, order):
+        # an arriving order first takes any liquidity it crosses, then joins the back of its price level
+
+        market = self.markets.get(order['ticker'])
+        if market is None:
+            order['queue_ahead'] = np.inf
+            return
+        yes_price = self._yes_price(order)
+        if order['side'] == 'yes' and market['yes_ask'] < 100 and market['yes_ask'] <= yes_price:
+            self._fill(order, market.get('yes_ask_size', order['remaining']), market['yes_ask'])
+        if order['side'] == 'no' and market['yes_bid'] > 0 and market['yes_bid'] >= yes_price:
+            self._fill(order, market.get('yes_bid_size', order['remaining']), 100 - market['yes_bid'])
+
+        level_size = self._level_size(order, market)
+        if level_size is not None:
+            order['queue_ahead'] = level_size
+        elif self._improves(order, market):
+            order['queue_ahead'] = 0 # alone at a new best price
+        else:
+            order['queue_ahead'] = np.inf # behind the best level, depth unknown until the book reaches us
+
+    def _yes_price(self, order):
+        # price of the order on the yes axis: a no bid at q is a yes offer at 100 - q
+        return order['price'] if order['side'] == 'yes' else 100 - order['price']
+
+    def _level_size(self, order, market):
+        # displayed size at the order's price on its own side, or None if that is not the best level
+        yes_price = self._yes_price(order)
+        if order['side'] == 'yes' and market['yes_bid'] == yes_price:
+            return market.get('yes_bid_size', 0)
+        if order['side'] == 'no' and market['yes_ask'] == yes_price:
+            return market.get('yes_ask_size', 0)
+        return None
+
+    def _improves(self, order, market):
+        if order['side'] == 'yes':
+            return self._yes_price(order) > market['yes_bid']
+        return self._yes_price(order) < market['yes_ask']
+
+    def _resting(self, ticker, side=None):
+        # active resting orders in price-time priority (best price first, then earliest)
+        orders = [o for o in self._open.values()
+                  if o['ticker'] == ticker and o['queue_ahead'] is not None
+                  and (side is None or o['side'] == side)]
+        return sorted(orders, key=lambda o: (-o['price'], o['seq']))
+
+    def _new_size(self, market, previous, price_key, size_key):
+        # size at the market's best level that was not already displayed at that price last snapshot
+        size = market.get(size_key, np.inf)
+        if previous is not None and previous[price_key] == market[price_key]:
+            if size_key not in market:
+                return 0
+            size -= previous.get(size_key, 0)
+        return max(size, 0)
+
+    def _match_crossed(self, market, previous):
+        # the book moved through our resting price, so contra orders would have traded with us at our price
+        # the recorded books never contain our orders, so only newly displayed contra size is matched
+
+        available = self._new_size(market, previous, 'yes_ask', 'yes_ask_size')
+        for order in self._resting(market['ticker'], 'yes'):
+            if market['yes_ask'] >= 100 or order['price'] < market['yes_ask'] or available <= 0:
+                break
+            available -= self._fill(order, available, order['price'])
+
+        available = self._new_size(market, previous, 'yes_bid', 'yes_bid_size')
+        for order in self._resting(market['ticker'], 'no'):
+            if market['yes_bid'] <= 0 or self._yes_price(order) > market['yes_bid'] or available <= 0:
+                break
+            available -= self._fill(order, available, order['price'])
+
+    def _match_trade(self, ticker, trade):
+        # a recorded print consumes resting orders in price-time priority
+        # orders priced better than the print fill first; at the print price we wait behind queue_ahead
+
+        remaining = trade['count']
+        side = 'yes' if trade['taker_side'] == 'no' else 'no'
+        for order in self._resting(ticker, side):
+            if remaining <= 0:
+                break
+            yes_price = self._yes_price(order)
+            if (side == 'yes' and yes_price < trade['yes_price']) or (side == 'no' and yes_price > trade['yes_price']):
+                break
+            if yes_price == trade['yes_price']:
+                ahead = min(order['queue_ahead'], remaining)
+                order['queue_ahead'] -= ahead
+                remaining -= ahead
+            remaining -= self._fill(order, remaining, order['price'])
+
+    def _fill(self, order, count, price):
+        # fill up to count contracts of order at price (on the order's side), return contracts filled
+
+        count = int(min(count, order['remaining']))
+        if count <= 0:
+            return 0
+        order['remaining'] -= count
+        if order['remaining'] == 0:
+            self._close(order, 'executed')
+
+        self._apply_fill(order['ticker'], order['side'], count, price)
+        self.fills.append({'ts': self.now, 'ticker': order['ticker'], 'side': order['side'],
+                           'count': count, 'price': price, 'order_id': order['order_id']})
+        return count
+
+    def _close(self, order, status):
+        order['status'] = status
+        self._open.pop(order['order_id'], None)
+
+    def _apply_fill(self, ticker, side, count, price):
+        # position is signed (+ yes, - no), cost is the cents paid for the open side
+        # buying the opposite side closes contracts first, each yes/no pair is worth 100
+
+        p = self.positions.setdefault(ticker, {'position': 0, 'cost': 0.0, 'realized': 0.0})
+        sign = 1 if side == 'yes' else -1
+        if p['position'] * sign < 0:
+            closed = min(count, abs(p['position']))
+            avg_cost = p['cost'] / abs(p['position'])
+            p['realized'] += closed * (100 - price - avg_cost)
+            p['cost'] -= closed * avg_cost
+            p['position'] += sign * closed
+            count -= closed
+        p['position'] += sign * count
+        p['cost'] += count * price
+
+    def settle(self, event_ticker, weekly_avg):
+        # settle every market of the event at the realized weekly average and cancel its orders
+        # settled markets leave positions, like on the real API, so they no longer count toward exposure
+
+        for order in list(self._open.values()):
+            if order['ticker'].startswith(event_ticker):
+                self._close(order, 'canceled')
+        for ticker in [t for t in self.positions if t.startswith(event_ticker) and t in self.markets]:
+            p = self.positions.pop(ticker)
+            yes_wins = weekly_avg > self.markets[ticker]['floor_strike']
+            if (p['position'] > 0) == yes_wins and p['position'] != 0:
+                p['realized'] += 100 * abs(p['position'])
+            self.settled_pnl[ticker] = p['realized'] - p['cost']
+        self.settled[event_ticker] = weekly_avg
+
+    def pnl(self):
+        # realized pnl in cents per market, settled or not
+        pnl = dict(self.settled_pnl)
+        pnl.update({ticker: p['realized'] for ticker, p in self.positions.items()})
+        return pnl
+
+
+def load_recording(path):
+    # read a recorded order book file, yielding market snapshots with ts parsed
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                market = json.loads(line)
+                market['ts'] = datetime.fromisoformat(market['ts'])
+                yield market
+
+def event_sunday(event_ticker):
+    # closing Sunday of an event, e.g. KXTSAW-25JUL13 -> 2025-07-13
+    code = event_ticker.split('-')[1]
+    months = {abbrev: month for month, abbrev in config.MONTH_ABBREVS.items()}
+    return datetime(2000 + int(code[:2]), months[code[2:5]], int(code[5:7]))
+
+def weekly_average(all_data, sunday):
+    # realized average passengers over the Monday-Sunday week ending on sunday
+    week = all_data[(all_data.date > sunday - timedelta(days=7)) & (all_data.date <= sunday)]
+    if len(week) < 7:
+        return None
+    return week.passengers.mean()
+
+def post_times(dates):
+    # when each date's TSA data becomes available
+    # a day is posted around PAPER_POST_HOUR on the following weekday, so Fri-Sun arrive on Monday
+
+    times = []
+    for date in dates:
+        post_day = date + timedelta(days=1)
+        while post_day.weekday() > 4:
+            post_day += timedelta(days=1)
+        times.append(post_day.replace(hour=config.PAPER_POST_HOUR))
+    return times
+
+def cutoff_at(ts, dates, times):
+    # most recent date with TSA data as of ts, given sorted dates and their post_times
+    i = bisect.bisect_right(times, ts)
+    return dates[i-1] if i > 0 else None
+
+def quote(most_recent_cutoff, theo_fn=None):
+    # one pass of the trader: cancel every quoted event's resting orders, then requote every market
+    # same calls as trader_main without the sleep between cancel and send
+
+    for yes, no in requote_events(most_recent_cutoff, theo_fn):
+        send_orders(yes, 'yes')
+        send_orders(no, 'no')
+
+def replay(snapshots, all_data, theo_fn=None, quote_every=timedelta(minutes=15), latency=0.0):
+    # replay recorded books through the paper exchange, quoting with the trader logic
+    # snapshots - iterable of market snapshots sorted by ts, e.g. load_recording(path)
+    # all_data - realized TSA data with date and passengers columns, used for cutoffs and settlement
+    # theo_fn - fair value function (date_string, strikes, week_ahead) -> probabilities in percent,
+    #           defaults to get_yes_probs
+    # returns the exchange, holding fills, positions and settled pnl
+
+    exchange = PaperExchange(latency)
+    api_helpers.set_paper_exchange(exchange)
+    dates = sorted(all_data.date)
+    times = post_times(dates)
+    posted_at = dict(zip(dates, times))
+    events = set()
+    try:
+        last_quote = None
+        for ts, group in itertools.groupby(snapshots, key=lambda m: m['ts']):
+            exchange.advance(ts)
+            for market in group:
+                exchange.update_book(market)
+                events.add(market['event_ticker'])
+
+            # settle each event once its Sunday is posted, so closed weeks stop using the exposure cap
+            for event_ticker in sorted(events - set(exchange.settled)):
+                sunday = event_sunday(event_ticker)
+                if sunday not in posted_at or posted_at[sunday] > ts:
+                    continue
+                avg = weekly_average(all_data, sunday)
+                if avg is not None:
+                    exchange.settle(event_ticker, avg)
+
+            if last_quote is not None and ts - last_quote < quote_every:
+                continue
+            cutoff = cutoff_at(ts, dates, times)
+            if cutoff is not None and get_next_sunday(cutoff) >= ts.replace(hour=0, minute=0, second=0, microsecond=0):
+                quote(cutoff, theo_fn)
+                last_quote = ts
+    finally:
+        api_helpers.set_paper_exchange(None)
+
+    # events whose Sunday is in the data but was posted after the recording ends
+    for event_ticker in sorted(events - set(exchange.settled)):
+        avg = weekly_average(all_data, event_sunday(event_ticker))
+        if avg is not None:
+            exchange.settle(event_ticker, avg)
+    return exchange
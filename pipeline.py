@@ -0,0 +1,161 @@
+import fcntl
+import os
+import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+import config
+
+# stages whose checkpoint marks a cutoff's pipeline as finished (non-streamed and streamed runs)
+FINAL_STAGES = ('write', 'stream')
+
+# checkpoint name under which the settings the stages ran with are recorded
+SETTINGS = 'settings'
+
+
+def checkpoint_dir(file_name):
+    # directory holding every checkpoint of a cutoff, e.g. checkpoints/25JUL13
+    return os.path.join(config.CHECKPOINT_DIR, file_name)
+
+def checkpoint_path(file_name, stage):
+    return os.path.join(checkpoint_dir(file_name), stage + '.pkl')
+
+def has_checkpoint(file_name, stage):
+    return os.path.exists(checkpoint_path(file_name, stage))
+
+def save_checkpoint(file_name, stage, value):
+    # pickle a stage's result, written to a temp file and renamed so a crash never leaves a partial checkpoint
+
+    path = checkpoint_path(file_name, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+def load_checkpoint(file_name, stage):
+    with open(checkpoint_path(file_name, stage), 'rb') as f:
+        return pickle.load(f)
+
+def lock_pipeline(file_name):
+    # take the cutoff's pipeline lock so two processes never work on the same cutoff
+    # returns the open lock file, to be passed to unlock_pipeline, or None if another process holds it
+    # the os releases the lock if the holder dies, so a crashed run never blocks the retry
+
+    os.makedirs(checkpoint_dir(file_name), exist_ok=True)
+    lock = open(os.path.join(checkpoint_dir(file_name), 'lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+def unlock_pipeline(lock):
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+def check_settings(file_name, settings):
+    # discard a cutoff's checkpoints if they were made under other settings, then record the current ones
+    # a directory without recorded settings is treated as stale too
+    # must be called with the pipeline lock held
+
+    if has_checkpoint(file_name, SETTINGS) and load_checkpoint(file_name, SETTINGS) == settings:
+        return
+    os.makedirs(checkpoint_dir(file_name), exist_ok=True)
+    stale = [name for name in os.listdir(checkpoint_dir(file_name)) if name.endswith('.pkl')]
+    if stale:
+        print('SETTINGS CHANGED, DISCARDING CHECKPOINTS:', file_name)
+    for name in stale:
+        os.remove(os.path.join(checkpoint_dir(file_name), name))
+    save_checkpoint(file_name, SETTINGS, settings)
+
+def pipeline_pending(file_name):
+    # True if a pipeline was started for the cutoff but did not finish, and nothing is working on it now
+
+    if not os.path.isdir(checkpoint_dir(file_name)):
+        return False
+    if any(has_checkpoint(file_name, stage) for stage in FINAL_STAGES):
+        return False
+    lock = lock_pipeline(file_name)
+    if lock is None:
+        return False
+    unlock_pipeline(lock)
+    return True
+
+def prune_checkpoints(most_recent_date):
+    # delete the checkpoints of cutoffs more than CHECKPOINT_RETENTION_DAYS before most_recent_date
+
+    if not os.path.isdir(config.CHECKPOINT_DIR):
+        return
+    oldest_kept = most_recent_date - timedelta(days=config.CHECKPOINT_RETENTION_DAYS)
+    for name in os.listdir(config.CHECKPOINT_DIR):
+        try:
+            cutoff = datetime.strptime(name, '%y%b%d')
+        except ValueError:
+            continue
+        if cutoff < oldest_kept:
+            shutil.rmtree(checkpoint_dir(name), ignore_errors=True)
+
+def run_stages(file_name, stages, target, settings=None):
+    # run a pipeline of checkpointed stages for a cutoff and return the target stage's result
+    # stages - dict of name -> (func, deps); func is called with the results of deps, in order
+    # settings - the config the stages depend on; checkpoints made under other settings are discarded
+    # stages with a checkpoint are not rerun, so a retry resumes from the first incomplete stage;
+    # a completed stage's checkpoint is only loaded if a stage that still has to run needs it
+    # stages whose dependencies are all done are run together, so independent stages overlap
+
+    check_settings(file_name, settings)
+    if has_checkpoint(file_name, target):
+        print('PIPELINE ALREADY DONE, RETURNING ITS CHECKPOINT:', file_name, target)
+
+    def required(name, needed):
+        # every stage needed to produce name, stopping at checkpoints
+        if name in needed:
+            return
+        needed.add(name)
+        if not has_checkpoint(file_name, name):
+            for dep in stages[name][1]:
+                required(dep, needed)
+
+    needed = set()
+    required(target, needed)
+
+    results = {}
+    to_run = {name for name in needed if not has_checkpoint(file_name, name)}
+    for name in needed - to_run:
+        results[name] = load_checkpoint(file_name, name)
+        print('CHECKPOINT LOADED:', file_name, name)
+
+    def run(name):
+        func, deps = stages[name]
+        value = func(*[results[dep] for dep in deps])
+        save_checkpoint(file_name, name, value)
+        return value
+
+    def collect(done):
+        for future in done:
+            name = running.pop(future)
+            results[name] = future.result() # re-raises a failed stage, after the stages already done were saved
+            print('STAGE DONE:', file_name, name)
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(len(to_run), 1)) as executor:
+        while to_run or running:
+            ready = [name for name in stages if name in to_run and all(dep in results for dep in stages[name][1])]
+            if not ready:
+                collect(wait(running, return_when=FIRST_COMPLETED)[0])
+                continue
+
+            # the first ready stage in declaration order runs on this thread, so it shows up when profiling;
+            # the others overlap with it on the pool
+            for name in ready:
+                print('STAGE STARTED:', file_name, name)
+                to_run.discard(name)
+            for name in ready[1:]:
+                running[executor.submit(run, name)] = name
+            results[ready[0]] = run(ready[0])
+            print('STAGE DONE:', file_name, ready[0])
+            collect([future for future in running if future.done()])
+
+    return results[target]
@@ -1,3 +1,5 @@
+import os
+import uuid
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
@@ -5,10 +7,19 @@ from prophet import Prophet
 from statsmodels.tsa.arima.model import ARIMA
 from tqdm import tqdm
 
-from helpers import get_next_sunday, get_previous_sunday, get_all_data, df_for_prophet, to_datetime
+from helpers import get_next_sunday, get_previous_sunday, get_all_data, get_most_recent_date, to_datetime
 import config
 
-from db_writer import create_preds_table, write_preds
+from db_writer import AWS_RDB_CLIENT, create_sims_run, write_preds, finish_sims_run, apply_sims_retention
+from model_selection import select_arma_order, selection_settings
+from forecaster import NativeForecaster
+from profiling import profiled
+from streaming import WeeklyAverageHistogram, simulate_chunks, chunk_rows, weekly_averages, histogram_path
+from streaming import SIM_BLOCK_SIZE
+from sharding import simulate_sharded, histogram_sharded, shard_seeds, model_state, rebuild_model
+from pipeline import run_stages, lock_pipeline, unlock_pipeline, prune_checkpoints
+from api_helpers import construct_file_name
+import db_configs
 
 CUTOFF = datetime(2022, 1, 1)
 PATH = 'all_data_raw.csv'
@@ -41,26 +52,114 @@ def fit_prophet(df_to_fit):
     prophet_model.fit(df_to_fit[['ds', 'y']])
     return prophet_model
 
-def simulate(arma_model, prophet_preds, nsims, anchor, days_left):
+def fit_native(df_to_fit):
+    # fit the NumPy least squares forecaster with the same components as fit_prophet
+
+    native_model = NativeForecaster(interval_width=0.95, changepoint_prior_scale=0.05)
+    native_model.add_seasonality(name='monthly', period=30.5, fourier_order=5)
+    native_model.add_country_holidays(country_name='US')
+    native_model.fit(df_to_fit[['ds', 'y']])
+    return native_model
+
+def fit_forecaster(df_to_fit):
+    # fit the deterministic component with the backend chosen in config
+
+    if config.FORECASTER == 'native':
+        return fit_native(df_to_fit)
+    if config.FORECASTER == 'prophet':
+        return fit_prophet(df_to_fit)
+    raise ValueError('unknown forecaster: ' + str(config.FORECASTER))
+
+def parity_check(df_to_fit, periods=7):
+    # fit both backends on the same data and compare their yhat over history and the forecast window
+    # returns dict of error metrics, in passengers
+
+    prophet_model = fit_prophet(df_to_fit)
+    prophet_forecast = prophet_model.predict(prophet_model.make_future_dataframe(periods=periods))
+    native_model = fit_native(df_to_fit)
+    native_forecast = native_model.predict(native_model.make_future_dataframe(periods=periods))
+
+    diff = np.array(native_forecast['yhat']) - np.array(prophet_forecast['yhat'])
+    return {
+        'history_rmse': np.sqrt(np.mean(np.square(diff[:-periods]))),
+        'history_max_abs': np.max(np.abs(diff[:-periods])),
+        'forecast_rmse': np.sqrt(np.mean(np.square(diff[-periods:]))),
+        'forecast_max_abs': np.max(np.abs(diff[-periods:])),
+    }
+
+def simulate(arma_model, prophet_preds, nsims, anchor, days_left, seed=None):
     # generate simulated paths that will be used to calculate fair values
     # arma_model - fitted arma model used to generate paths
-    # prophet_preds - Prophet point predictions for the remainder of the week
+    # prophet_preds - Prophet point predictions for the remainder of the week and any weeks after it
     # nsims - how many simulations to generate
     # anchor - first simulation day
     # days_left - how many days to simulate, i.e. if the most recent date is a Thursday, days left is 3
+    #             (10 when the following week is simulated too)
+    # seed - master seed; the same seed and config.SIM_SHARDS always reproduce the same paths
 
     print('FIRST SIM DAY:', anchor)
-    sims = np.array([np.zeros(days_left)])
-    for i in range(nsims):
-        # simulate path
-        sims = np.vstack((sims, arma_model.simulate(nsimulations=days_left, anchor=anchor)))
-    sims = sims[1:]
-    
-    # combine arma sims with prophet preds
-    preds = prophet_preds - sims
+    if config.SIM_SHARDS > 1:
+        # split the sims over a process pool, one independent random stream per shard
+        return simulate_sharded(arma_model, prophet_preds, nsims, anchor, days_left, seed,
+                                config.SIM_SHARDS, config.SIM_WORKERS, config.SIM_CHUNK_SIZE)
+
+    # simulate in vectorized chunks rather than one path at a time
+    chunks = simulate_chunks(arma_model, prophet_preds, nsims, anchor, days_left, config.SIM_CHUNK_SIZE,
+                             seed_seq=shard_seeds(seed, 1)[0])
+    preds = np.vstack(list(chunks))
 
     return preds # array of size nsims x days_left
 
+def stream_predictions(arma_model, prophet_preds, nsims, anchor, days_left, previous_results, most_recent_date,
+                       seed=None, run_id=None, model_version=None):
+    # memory-bounded alternative to simulate + append_previous_results + write_preds
+    # paths are generated SIM_CHUNK_SIZE at a time and reduced straight into one weekly average histogram
+    # per simulated week; each chunk is optionally written to the sims table, so peak memory does not grow
+    # with nsims
+    # returns list of histograms, the current week's first
+
+    print('FIRST SIM DAY:', anchor)
+    dtype = np.dtype(config.SIM_DTYPE)
+    bins = (config.HIST_LOWER, config.HIST_UPPER, config.HIST_BIN_WIDTH)
+    weeks = (len(previous_results) + days_left) // 7
+
+    if config.SIM_SHARDS > 1 and not config.STREAM_WRITE_SIMS:
+        # each shard reduces its own paths into histograms, merged here in shard order
+        hists = histogram_sharded(arma_model, prophet_preds, nsims, anchor, days_left, previous_results, bins,
+                                 seed, config.SIM_SHARDS, config.SIM_WORKERS, config.SIM_CHUNK_SIZE, dtype)
+    else:
+        hists = [WeeklyAverageHistogram(*bins) for _ in range(weeks)]
+
+        client = None
+        if config.STREAM_WRITE_SIMS:
+            # written chunks always come from a single stream, even when SIM_SHARDS > 1
+            create_sims_run(most_recent_date, run_id, nsims, seed, model_version, weeks, 1, SIM_BLOCK_SIZE)
+            client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
+                                    db_configs.DB_USER, db_configs.DB_PASSWORD)
+
+        written = 0
+        for chunk in tqdm(simulate_chunks(arma_model, prophet_preds, nsims, anchor, days_left,
+                                          config.SIM_CHUNK_SIZE, dtype, shard_seeds(seed, 1)[0]),
+                          total=-(-nsims // chunk_rows(config.SIM_CHUNK_SIZE))):
+            for hist, weekly_avgs in zip(hists, weekly_averages(chunk, previous_results).T):
+                hist.add(weekly_avgs)
+            if client is not None:
+                write_preds(append_previous_results(len(chunk), chunk, previous_results), most_recent_date,
+                            run_id, client, written)
+                written += len(chunk)
+
+        if client is not None:
+            finish_sims_run(run_id)
+            apply_sims_retention(most_recent_date)
+
+    # save the histograms so the trader can price strikes without reading every sim back
+    os.makedirs(config.HIST_DIR, exist_ok=True)
+    for week_ahead, hist in enumerate(hists):
+        hist.save(histogram_path(construct_file_name(most_recent_date), week_ahead))
+        print('WEEK', week_ahead, 'WEEKLY AVG MEAN:', hist.mean(), 'STD:', hist.std())
+
+    return hists
+
 def get_previous_results(all_data, most_recent_cutoff):
     # get actual passenger values already recorded this week
     # e.g. if most recent cutoff is a Wednesday, return the values from Mon, Tue, and Wed
@@ -72,11 +171,11 @@ def get_previous_results(all_data, most_recent_cutoff):
 
 def append_previous_results(nsims, preds, previous_results):
     # append each simulation row with the week's actual passenger values
-    # this creates an array of size nsims x 7
-    # these rows can then be averaged to simulate a draw from the week's average distribution
+    # this creates an array of size nsims x 7 (nsims x 7*weeks when later weeks are simulated too)
+    # every 7 columns of a row can then be averaged to simulate a draw from that week's average distribution
 
-    prev_extended = np.tile(previous_results, (nsims,1))
-    assert np.hstack((prev_extended, preds)).shape[1] == 7
+    prev_extended = np.tile(np.asarray(previous_results, dtype=preds.dtype), (nsims,1))
+    assert (prev_extended.shape[1] + preds.shape[1]) % 7 == 0
     return np.hstack((prev_extended, preds))
 
 
@@ -91,58 +190,137 @@ def save_preds(preds, most_recent_cutoff):
     np.save(path, preds)
 
 
-def generate_predictions(nsims):
-    # big function to generate and store simulation results in the AWS db
-
-    # get df for Prophet and big time series df
-    df_to_fit = df_for_prophet(CUTOFF)
-    all_data = get_all_data()
-
-    most_recent_date = all_data.iloc[-1, 0]
-    most_recent_datetime = to_datetime(most_recent_date)
-    
-    print('MOST RECENT: ', most_recent_datetime)
-    
-    # next sunday datetime
-    next_sunday = get_next_sunday(most_recent_datetime)
-    print('NEXT SUNDAY: ', next_sunday)
+def fit_stage(all_data):
+    # pipeline stage: fit the forecaster and forecast the training set plus every simulated day
+    # returns the forecast df
 
-    # days to forecast
-    days_left = (next_sunday - most_recent_datetime).days
+    most_recent_datetime = to_datetime(all_data.iloc[-1, 0])
+    days_left = days_to_simulate(most_recent_datetime)
     print('DAYS TO FORECAST: ', days_left)
 
-    # fit prophet and forecast both over training set and remainder of week
-    prophet_model = fit_prophet(df_to_fit)
+    df_to_fit = all_data[all_data.date >= CUTOFF].rename(columns={'date':'ds', 'passengers':'y'})
+    prophet_model = fit_forecaster(df_to_fit)
     future = prophet_model.make_future_dataframe(periods=days_left)
     forecast = prophet_model.predict(future)
     print('prophet forecasted')
+    return forecast
 
-    
-    # fit arma model on prophet errors over training set
+def arma_stage(all_data, forecast):
+    # pipeline stage: select and fit the arma model on the forecast errors over the training set
+    # returns dict with the model state (see sharding.model_state) and the model version stored with runs
+
+    most_recent_datetime = to_datetime(all_data.iloc[-1, 0])
     arma_df = df_for_arma(forecast, all_data, most_recent_datetime)
-    arma_model = fit_arma(arma_df, 14, 0, 14)
+    p, d, q = select_arma_order(arma_df, most_recent_datetime)
+    arma_model = fit_arma(arma_df, p, d, q)
     print('arma fit')
+    return {'state': model_state(arma_model), 'model_version': config.FORECASTER + '+arima' + str((p, d, q))}
 
-    
-    # simulate outcomes over the remainder of the week
-    # combine with prophet predictions
+def sim_inputs(all_data, forecast, arma):
+    # everything the simulation needs, rebuilt from the data, forecast and arma stage results
+
+    most_recent_datetime = to_datetime(all_data.iloc[-1, 0])
+    days_left = days_to_simulate(most_recent_datetime)
+    arma_model = rebuild_model(*arma['state'])
     prophet_preds = np.array(forecast.tail(days_left)['yhat'])
     anchor = most_recent_datetime + timedelta(days=1)
-    preds = simulate(arma_model, prophet_preds, nsims, anchor, days_left)
-
-    # append this week's recorded values to simulated results
     previous_results = get_previous_results(all_data, most_recent_datetime)
-    extended_preds = append_previous_results(nsims, preds, previous_results)
-
-    print(extended_preds)
-
-    #save_preds(np.mean(extended_preds, axis=1), most_recent_datetime)
 
-    # save the simulation results (size nsims x 7) in db in sims schema
-    create_preds_table(most_recent_datetime)
-    write_preds(extended_preds, most_recent_datetime)
-
-    return np.mean(extended_preds, axis=1) # nsims X 1 array containing weekly averages
+    # fresh entropy unless a seed is configured, printed so any run can be reproduced
+    seed = config.SIM_SEED if config.SIM_SEED is not None else np.random.SeedSequence().entropy
+    print('SIM SEED:', seed)
+    return most_recent_datetime, days_left, arma_model, prophet_preds, anchor, previous_results, seed
+
+def pipeline_settings(nsims, stream):
+    # config the pipeline stages depend on, recorded with a cutoff's checkpoints so a retry under
+    # different settings starts over instead of reusing them
+    return {'nsims': nsims, 'stream': stream, 'forecast_weeks': config.FORECAST_WEEKS,
+            'forecaster': config.FORECASTER, 'arma_order': tuple(config.ARMA_ORDER),
+            'arma_selection': selection_settings(), 'sim_seed': config.SIM_SEED, 'sim_shards': config.SIM_SHARDS,
+            'sim_dtype': config.SIM_DTYPE, 'stream_write_sims': config.STREAM_WRITE_SIMS,
+            'hist_bins': (config.HIST_LOWER, config.HIST_UPPER, config.HIST_BIN_WIDTH)}
+
+def days_to_simulate(most_recent_datetime):
+    # the rest of this week, plus every following week simulated from the same fit
+    return (get_next_sunday(most_recent_datetime) - most_recent_datetime).days + 7 * (config.FORECAST_WEEKS - 1)
+
+@profiled('generate_predictions')
+def generate_predictions(nsims, stream=None):
+    # big function to generate and store simulation results in the AWS db
+    # stream - if True, use the memory-bounded chunked pipeline (defaults to config.STREAM_SIMS)
+    #
+    # runs as checkpointed stages keyed by the cutoff date (see pipeline.run_stages):
+    # data -> fit -> arma -> sims -> write, with retention alongside,
+    # or data -> fit -> arma -> stream for streamed runs
+    # if a stage fails, the next call for the same cutoff resumes from the first incomplete stage,
+    # unless the settings it depends on (see pipeline_settings) changed in between
+    # returns None if another process is already working on this cutoff
+
+    most_recent_datetime = to_datetime(get_most_recent_date())
+    file_name = construct_file_name(most_recent_datetime)
+    print('MOST RECENT: ', most_recent_datetime)
+    print('NEXT SUNDAY: ', get_next_sunday(most_recent_datetime))
+
+    lock = lock_pipeline(file_name)
+    if lock is None:
+        print('PIPELINE ALREADY RUNNING FOR', file_name)
+        return None
+
+    if stream is None:
+        stream = config.STREAM_SIMS
+
+    def data_stage():
+        # TSA rows the whole pipeline works from, so a resumed run fits exactly the same data
+        all_data = get_all_data()
+        return all_data[all_data.date <= most_recent_datetime]
+
+    def sims_stage(all_data, forecast, arma):
+        # simulate outcomes over the remainder of the week and the following weeks as joint paths
+        # combine with prophet predictions
+        _, days_left, arma_model, prophet_preds, anchor, previous_results, seed = sim_inputs(
+            all_data, forecast, arma)
+        preds = simulate(arma_model, prophet_preds, nsims, anchor, days_left, seed)
+
+        # append this week's recorded values to simulated results
+        extended_preds = append_previous_results(nsims, preds, previous_results)
+        print(extended_preds)
+        return {'preds': extended_preds, 'seed': seed}
+
+    def write_stage(sims, arma, retention):
+        # save the simulation results (size nsims x 7*weeks) as a new run in the sims store
+        # retention is only a dependency so its partition drops are done before this partition is written
+        run_id = str(uuid.uuid4())
+        create_sims_run(most_recent_datetime, run_id, nsims, sims['seed'], arma['model_version'], config.FORECAST_WEEKS,
+                        config.SIM_SHARDS, SIM_BLOCK_SIZE)
+        write_preds(sims['preds'], most_recent_datetime, run_id)
+        finish_sims_run(run_id)
+        return {'run_id': run_id, 'weekly_avgs': sims['preds'].reshape(nsims, -1, 7).mean(axis=2)}
+
+    def stream_stage(all_data, forecast, arma):
+        _, days_left, arma_model, prophet_preds, anchor, previous_results, seed = sim_inputs(
+            all_data, forecast, arma)
+        return stream_predictions(arma_model, prophet_preds, nsims, anchor, days_left, previous_results,
+                                  most_recent_datetime, seed, str(uuid.uuid4()), arma['model_version'])
+
+    stages = {
+        'data': (data_stage, ()),
+        'fit': (fit_stage, ('data',)),
+        'arma': (arma_stage, ('data', 'fit')),
+        'sims': (sims_stage, ('data', 'fit', 'arma')),
+        # summarize and drop sims past retention while the models fit and simulate
+        'retention': (lambda: apply_sims_retention(most_recent_datetime), ()),
+        'write': (write_stage, ('sims', 'arma', 'retention')),
+        'stream': (stream_stage, ('data', 'fit', 'arma')),
+    }
+
+    try:
+        settings = pipeline_settings(nsims, stream)
+        if stream:
+            return run_stages(file_name, stages, 'stream', settings) # weekly average histograms
+        return run_stages(file_name, stages, 'write', settings)['weekly_avgs'] # nsims X weeks array containing weekly averages
+    finally:
+        unlock_pipeline(lock)
+        prune_checkpoints(most_recent_datetime)
 
 #preds = generate_predictions(100000)
 #print('forecast: ', np.percentile(preds, 50))
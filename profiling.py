@@ -0,0 +1,168 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+import config
+
+# stages currently being profiled, outermost first
+STAGES = []
+
+# directory of the current profiled run, created on first use
+RUN_DIR = None
+
+# number of stages written so far in this run, used to keep file names unique and ordered
+STAGE_COUNT = 0
+
+# sampling thread shared by all stages of a run
+SAMPLER = None
+
+# True if tracemalloc was started here, so it is only stopped here too
+STARTED_TRACING = False
+
+
+class StackSampler(threading.Thread):
+    # sampling profiler: records the profiled thread's call stack every interval seconds
+    # each sample is credited to every stage active at that moment, in flamegraph folded format
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+                frame = frame.f_back
+            folded = ';'.join(reversed(names))
+            for stage in list(STAGES):
+                stage['samples'][folded] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def get_run_dir():
+    # make a timestamped directory for this run under config.PROFILE_DIR
+    global RUN_DIR
+    if RUN_DIR is None:
+        RUN_DIR = os.path.join(config.PROFILE_DIR, datetime.now().strftime('%Y%m%d_%H%M%S'))
+        os.makedirs(RUN_DIR, exist_ok=True)
+    return RUN_DIR
+
+def start_stage(name):
+    # pause the enclosing stage's deterministic profiler and start this stage's
+
+    global SAMPLER, STARTED_TRACING
+    if STAGES:
+        parent = STAGES[-1]
+        parent['profile'].disable()
+        parent['peak'] = max(parent['peak'], tracemalloc.get_traced_memory()[1])
+    else:
+        STARTED_TRACING = not tracemalloc.is_tracing()
+        if STARTED_TRACING:
+            tracemalloc.start(config.PROFILE_TRACEBACK_DEPTH)
+        SAMPLER = StackSampler(threading.get_ident(), config.PROFILE_SAMPLE_INTERVAL)
+        SAMPLER.start()
+
+    tracemalloc.reset_peak()
+    stage = {
+        'name': name,
+        'profile': cProfile.Profile(),
+        'descendants': [], # profiles of nested stages, merged back so every stage's pstats is inclusive
+        'samples': Counter(),
+        'snapshot': tracemalloc.take_snapshot(),
+        'peak': 0,
+        'start': time.perf_counter(),
+    }
+    STAGES.append(stage)
+    stage['profile'].enable()
+    return stage
+
+def end_stage(stage):
+    # stop the stage, write its outputs and resume the enclosing stage
+
+    global SAMPLER, STAGE_COUNT
+    stage['profile'].disable()
+    elapsed = time.perf_counter() - stage['start']
+    peak = max(stage['peak'], tracemalloc.get_traced_memory()[1])
+    snapshot = tracemalloc.take_snapshot()
+    STAGES.pop()
+
+    if not STAGES:
+        SAMPLER.stop()
+        SAMPLER = None
+    STAGE_COUNT += 1
+    write_stage(stage, STAGE_COUNT, elapsed, peak, snapshot)
+
+    if STAGES:
+        parent = STAGES[-1]
+        parent['descendants'] += [stage['profile']] + stage['descendants']
+        parent['profile'].enable()
+    elif STARTED_TRACING:
+        tracemalloc.stop()
+
+def write_stage(stage, index, elapsed, peak, snapshot):
+    # <n>_<stage>.pstats - deterministic profile, including nested stages (snakeviz, gprof2dot, pstats)
+    # <n>_<stage>.folded - sampled stacks, one 'frame;frame;frame count' line per stack (flamegraph.pl, speedscope)
+    # <n>_<stage>_cpu.txt - top functions by cumulative time
+    # <n>_<stage>_alloc.txt - wall time, peak traced memory and top allocation sites during the stage
+
+    prefix = os.path.join(get_run_dir(), '{:02d}_{}'.format(index, stage['name']))
+
+    stats = pstats.Stats(stage['profile'])
+    for profile in stage['descendants']:
+        stats.add(profile)
+    stats.dump_stats(prefix + '.pstats')
+
+    text = io.StringIO()
+    pstats.Stats(prefix + '.pstats', stream=text).sort_stats('cumulative').print_stats(config.PROFILE_TOP_N)
+    with open(prefix + '_cpu.txt', 'w') as f:
+        f.write(text.getvalue())
+
+    with open(prefix + '.folded', 'w') as f:
+        for folded, count in stage['samples'].most_common():
+            f.write(folded + ' ' + str(count) + '\n')
+
+    with open(prefix + '_alloc.txt', 'w') as f:
+        f.write('stage: {}\nwall time: {:.3f} s\npeak traced memory: {:.1f} MiB\n\n'.format(
+            stage['name'], elapsed, peak / 2**20))
+        f.write('top allocation sites (net growth over the stage):\n')
+        # leave out the profiler's own bookkeeping
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, pstats.__file__),
+                  tracemalloc.Filter(False, __file__)]
+        growth = snapshot.filter_traces(ignore).compare_to(stage['snapshot'].filter_traces(ignore), 'lineno')
+        for stat in growth[:config.PROFILE_TOP_N]:
+            f.write(str(stat) + '\n')
+
+    print('PROFILED', stage['name'], 'IN {:.1f} s, PEAK {:.1f} MiB ->'.format(elapsed, peak / 2**20), prefix)
+
+def profiled(name):
+    # decorator profiling a pipeline stage when config.PROFILE_DIR is set, and a no-op otherwise
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if config.PROFILE_DIR is None:
+                return func(*args, **kwargs)
+            stage = start_stage(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end_stage(stage)
+        return wrapper
+    return decorator
@@ -0,0 +1,82 @@
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from statsmodels.tsa.arima.model import ARIMA
+
+from streaming import WeeklyAverageHistogram, simulate_chunks, weekly_averages
+
+# fitted ARMA rebuilt once in each worker process by init_worker
+WORKER_MODEL = None
+
+
+def model_state(arma_model):
+    # the small pieces needed to rebuild a fitted ARMA: the error series, the order and the parameters
+    # a few KB instead of the full results object with all its filter output
+    return (arma_model.model.data.orig_endog, arma_model.model.order, np.asarray(arma_model.params))
+
+def rebuild_model(endog, order, params):
+    # fitted ARMA from model_state, by filtering with the given parameters, no refit
+    return ARIMA(endog, order=order, freq='D').filter(params)
+
+def init_worker(endog, order, params):
+    # process pool initializer: rebuild the fitted model once per worker
+    global WORKER_MODEL
+    WORKER_MODEL = rebuild_model(endog, order, params)
+
+def shard_sizes(nsims, nshards):
+    # split nsims as evenly as possible, earlier shards taking the remainder
+    base, extra = divmod(nsims, nshards)
+    return [base + (1 if i < extra else 0) for i in range(nshards)]
+
+def shard_seeds(seed, nshards):
+    # independent random streams for each shard, all derived from one master seed
+    return np.random.SeedSequence(seed).spawn(nshards)
+
+def simulate_shard(args):
+    # simulate one shard's paths with its own random stream
+    nsims, prophet_preds, anchor, days_left, seed_seq, chunk_size, dtype = args
+    chunks = simulate_chunks(WORKER_MODEL, prophet_preds, nsims, anchor, days_left, chunk_size, dtype, seed_seq)
+    return np.vstack(list(chunks))
+
+def histogram_shard(args):
+    # simulate one shard and reduce it straight into one weekly average histogram per simulated week
+    # only the histograms travel back to the parent, whatever the shard size
+    nsims, prophet_preds, anchor, days_left, seed_seq, chunk_size, dtype, previous_results, bins = args
+    hists = [WeeklyAverageHistogram(*bins) for _ in range((len(previous_results) + days_left) // 7)]
+    for chunk in simulate_chunks(WORKER_MODEL, prophet_preds, nsims, anchor, days_left, chunk_size, dtype,
+                                 seed_seq):
+        for hist, weekly_avgs in zip(hists, weekly_averages(chunk, previous_results).T):
+            hist.add(weekly_avgs)
+    return hists
+
+def run_shards(arma_model, func, tasks, workers):
+    # map shard tasks over a pool whose workers each rebuild the model once
+    # results come back in shard order, so merging does not depend on which worker finished first
+    # workers start from a forkserver, since forking while other pipeline stages run on threads can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=init_worker, initargs=model_state(arma_model)) as executor:
+        return list(executor.map(func, tasks))
+
+def simulate_sharded(arma_model, prophet_preds, nsims, anchor, days_left, seed, nshards, workers=None,
+                     chunk_size=100000, dtype=np.float64):
+    # sharded version of simulate: split nsims over nshards seeded streams and run them on a process pool
+    # the result only depends on seed and nshards, not on the number of workers or the chunk size
+    # returns array of size nsims x days_left
+
+    tasks = [(n, prophet_preds, anchor, days_left, seed_seq, chunk_size, dtype)
+             for n, seed_seq in zip(shard_sizes(nsims, nshards), shard_seeds(seed, nshards))]
+    return np.vstack(run_shards(arma_model, simulate_shard, tasks, workers))
+
+def histogram_sharded(arma_model, prophet_preds, nsims, anchor, days_left, previous_results, bins, seed,
+                      nshards, workers=None, chunk_size=100000, dtype=np.float64):
+    # sharded version of the streaming reduction, merging the histograms of every shard week by week
+    # bins - (lower, upper, bin_width) of the weekly average histograms
+    # returns list of histograms, one per simulated week
+
+    tasks = [(n, prophet_preds, anchor, days_left, seed_seq, chunk_size, dtype, previous_results, bins)
+             for n, seed_seq in zip(shard_sizes(nsims, nshards), shard_seeds(seed, nshards))]
+    shard_hists = run_shards(arma_model, histogram_shard, tasks, workers)
+    for hists in shard_hists[1:]:
+        for merged, hist in zip(shard_hists[0], hists):
+            merged.merge(hist)
+    return shard_hists[0]
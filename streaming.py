@@ -0,0 +1,149 @@
+import os
+import numpy as np
+
+import config
+
+# paths drawn from one random stream, fixed so the sims only depend on the seed and not on the chunk size
+SIM_BLOCK_SIZE = 1000
+
+
+class WeeklyAverageHistogram:
+    # fixed-bin histogram of simulated weekly averages
+    # memory depends only on the bin count, so it can absorb any number of sims chunk by chunk
+    def __init__(self, lower, upper, bin_width):
+        self.edges = np.arange(lower, upper + bin_width, bin_width, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64) # includes under/overflow buckets
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, weekly_avgs):
+        # fold a chunk of weekly averages into the running statistics
+
+        weekly_avgs = np.asarray(weekly_avgs, dtype=np.float64)
+        self.counts += np.bincount(np.searchsorted(self.edges, weekly_avgs, side='right'),
+                                   minlength=len(self.counts))
+        self.n += len(weekly_avgs)
+        self.total += weekly_avgs.sum()
+        self.total_sq += np.square(weekly_avgs).sum()
+        self.min = min(self.min, weekly_avgs.min())
+        self.max = max(self.max, weekly_avgs.max())
+
+    def merge(self, other):
+        # fold another histogram with the same bins into this one, e.g. from another shard
+
+        assert np.array_equal(self.edges, other.edges)
+        self.counts += other.counts
+        self.n += other.n
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def mean(self):
+        return self.total / self.n
+
+    def std(self):
+        return np.sqrt(max(self.total_sq / self.n - self.mean()**2, 0))
+
+    def prob_above(self, strike):
+        # fraction of sims whose weekly average is above the strike
+        # exact when the strike falls on a bin edge, linearly interpolated within a bin otherwise
+
+        i = np.searchsorted(self.edges, strike, side='right') # bucket containing the strike
+        above = self.counts[i+1:].sum()
+        if 0 < i < len(self.edges):
+            lo, hi = self.edges[i-1], self.edges[i]
+            above += self.counts[i] * (hi - strike) / (hi - lo)
+        return above / self.n
+
+    def quantile(self, q):
+        # approximate quantile by interpolating the cumulative counts over the bin edges
+
+        cum = np.cumsum(self.counts[1:-1]) + self.counts[0]
+        target = q * self.n
+        i = np.searchsorted(cum, target)
+        if i >= len(cum):
+            return self.max
+        prev = cum[i-1] if i > 0 else self.counts[0]
+        frac = (target - prev) / max(cum[i] - prev, 1)
+        return self.edges[i] + frac * (self.edges[i+1] - self.edges[i])
+
+    def save(self, path):
+        np.savez(path, edges=self.edges, counts=self.counts,
+                 stats=np.array([self.n, self.total, self.total_sq, self.min, self.max]))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        hist = cls.__new__(cls)
+        hist.edges = data['edges']
+        hist.counts = data['counts']
+        n, hist.total, hist.total_sq, hist.min, hist.max = data['stats']
+        hist.n = int(n)
+        return hist
+
+
+def simulate_chunk(arma_model, prophet_preds, nsims, anchor, days_left, dtype=np.float64, random_state=None):
+    # simulate nsims paths in a single vectorized call and combine them with the Prophet preds
+    # random_state - optional np.random.Generator, so runs can be reproduced from a seed
+    # returns array of size nsims x days_left
+
+    sims = arma_model.simulate(nsimulations=days_left, anchor=anchor, repetitions=nsims,
+                               random_state=random_state)
+    sims = np.asarray(sims, dtype=np.float64).reshape(days_left, nsims).T
+    return (prophet_preds - sims).astype(dtype, copy=False)
+
+def block_seed(seed_seq, block):
+    # random stream of one block of paths, the child seed_seq.spawn would return for that block
+    # built directly, so it does not depend on how many children were spawned before
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key=seed_seq.spawn_key + (block,),
+                                  pool_size=seed_seq.pool_size)
+
+def chunk_rows(chunk_size):
+    # rows in each chunk yielded by simulate_chunks: chunk_size rounded down to whole blocks, at least one
+    return max(chunk_size // SIM_BLOCK_SIZE, 1) * SIM_BLOCK_SIZE
+
+def simulate_chunks(arma_model, prophet_preds, nsims, anchor, days_left, chunk_size, dtype=np.float64,
+                    seed_seq=None):
+    # yield simulated paths chunk_rows(chunk_size) rows at a time so only one chunk is ever held in memory
+    # seed_seq - np.random.SeedSequence; every SIM_BLOCK_SIZE paths are drawn from their own stream spawned
+    #            from it and chunks are made of whole blocks, so the paths do not depend on chunk_size
+
+    if seed_seq is None:
+        seed_seq = np.random.SeedSequence()
+    blocks_per_chunk = chunk_rows(chunk_size) // SIM_BLOCK_SIZE
+
+    done = 0
+    block = 0
+    while done < nsims:
+        chunk = []
+        for _ in range(blocks_per_chunk):
+            if done == nsims:
+                break
+            n = min(SIM_BLOCK_SIZE, nsims - done)
+            rng = np.random.default_rng(block_seed(seed_seq, block))
+            chunk.append(simulate_chunk(arma_model, prophet_preds, n, anchor, days_left, dtype, rng))
+            done += n
+            block += 1
+        yield np.vstack(chunk)
+
+def weekly_averages(preds, previous_results):
+    # weekly average of each simulated path for every week it covers, without building the full nsims x 7 matrix
+    # preds - nsims x days array, days being the rest of the current week plus any whole weeks after it
+    # returns array of size nsims x weeks
+
+    first = 7 - len(previous_results) # simulated days in the current week
+    current = (np.sum(previous_results) + preds[:, :first].sum(axis=1, dtype=np.float64)) / 7
+    later = preds[:, first:].reshape(len(preds), -1, 7).mean(axis=2, dtype=np.float64)
+    return np.column_stack((current, later))
+
+def histogram_path(file_name, week_ahead=0):
+    # local path of the histogram stored for a cutoff, e.g. sims/25JUL13_hist.npz
+    # weeks after the current one get their own file, e.g. sims/25JUL13_w1_hist.npz
+    if week_ahead:
+        file_name += '_w' + str(week_ahead)
+    return os.path.join(config.HIST_DIR, file_name + '_hist.npz')
@@ -1,4 +1,6 @@
 import numpy as np
+import os
+from datetime import datetime
 import time
 import uuid
 
@@ -7,103 +9,178 @@ import config
 from psycopg2 import sql
 
 from api_helpers import get_markets, get_positions, construct_event_ticker
-from api_helpers import calc_net_position_ticker, construct_file_name, get_all_orders, call_api
+from api_helpers import calc_net_position, construct_file_name, get_all_orders, call_api
 import db_configs
-from db_writer import AWS_RDB_CLIENT
+from db_writer import AWS_RDB_CLIENT, get_latest_run
+from streaming import WeeklyAverageHistogram, histogram_path
+from profiling import profiled
 
     
-def get_yes_prob(most_recent_date_string, strike):
-    # given a strike, calculate it's fair probability of resulting to yes
-    # calulate percentage of simulation rows whose average is greater than the strike
+def get_weekly_averages(most_recent_date_string, week_ahead=0):
+    # read the latest simulation run for a cutoff from the db and return each sim's weekly average
+    # week_ahead - which simulated week, 0 being the current event's week
+    # returns an empty array if the run does not simulate that week
 
     client = AWS_RDB_CLIENT(db_configs.DB_HOST, db_configs.DB_PORT, db_configs.DB_NAME,
                             db_configs.DB_USER, db_configs.DB_PASSWORD)
-    # read simulations from db
-    query = sql.SQL(db_configs.QUERY_ALL_SCHEMA).format(table=sql.Identifier(most_recent_date_string),
-                                                 schema=sql.Identifier('sims'))
-    preds = client.query_sql(query)
-    
-    # average across rows and return number of averages greater than the strike
-    preds_avg = np.array(preds.mean(axis=1))
-
-    return round(100*sum(preds_avg>strike)/len(preds_avg), 0)
+    cutoff = datetime.strptime(most_recent_date_string, '%y%b%d')
+    run_id = get_latest_run(client, cutoff)
+
+    if run_id is None:
+        if week_ahead:
+            return np.empty(0)
+        # cutoffs simulated before the consolidated store have their own table in the sims schema
+        query = sql.SQL(db_configs.QUERY_ALL_SCHEMA).format(table=sql.Identifier(most_recent_date_string),
+                                                     schema=sql.Identifier(db_configs.SIMS_SCHEMA))
+        return client.query_array(query).mean(axis=1)
+
+    # the db averages each sim, so only one column is transferred
+    query = sql.SQL(db_configs.QUERY_RUN_WEEKLY_AVGS).format(schema=sql.Identifier(db_configs.SIMS_SCHEMA),
+                                                              table=sql.Identifier(db_configs.SIMS_TABLE))
+    preds_avg = client.query_array(query, (cutoff.date(), run_id, week_ahead))
+    return preds_avg[:, 0] if len(preds_avg) else np.empty(0)
+
+def get_yes_probs(most_recent_date_string, strikes, week_ahead=0):
+    # fair probability (in percent) of every strike resolving to yes, reading the simulations once
+    # calulate percentage of simulation rows whose average is greater than each strike
+    # week_ahead - which upcoming event to price, 0 being the current one
+    # returns None if there are no simulations for that week
+
+    strikes = np.asarray(strikes, dtype=np.float64)
+
+    # streamed runs leave a weekly average histogram behind, which is much cheaper to read
+    path = histogram_path(most_recent_date_string, week_ahead)
+    if os.path.exists(path):
+        hist = WeeklyAverageHistogram.load(path)
+        return np.round(100*np.array([hist.prob_above(strike) for strike in strikes]), 0)
+
+    preds_avg = np.sort(get_weekly_averages(most_recent_date_string, week_ahead))
+    if len(preds_avg) == 0:
+        return None
+    n_above = len(preds_avg) - np.searchsorted(preds_avg, strikes, side='right')
+    return np.round(100*n_above/len(preds_avg), 0)
+
+def market_arrays(markets, positions):
+    # hold the event's markets as columnar arrays so quotes can be computed in one vectorized pass
+    # positions - all positions, used for each market's net position
+
+    net_by_ticker = {}
+    for position in positions:
+        net_by_ticker[position['ticker']] = np.sign(position['position']) * position['market_exposure']
+
+    return {
+        'tickers': np.array([market['ticker'] for market in markets], dtype=object),
+        'strikes': np.array([market['floor_strike'] for market in markets], dtype=np.float64),
+        'yes_bids': np.array([market['yes_bid'] for market in markets], dtype=np.float64),
+        'yes_asks': np.array([market['yes_ask'] for market in markets], dtype=np.float64),
+        'net_positions': np.array([net_by_ticker.get(market['ticker'], 0) for market in markets], dtype=np.float64),
+    }
 
-def create_orders(most_recent_cutoff):
+def quote_markets(books, theos, net_exposure, reserved=(0, 0)):
+    # compute every yes and no bid in one pass
+    # books - dict of columnar arrays from market_arrays
+    # theos - fair yes probability in percent for each market
+    # net_exposure - current dollar net exposure across the whole portfolio
+    # reserved - (long, short) exposure of orders already created for other events in this pass
+    # returns yes prices, yes sizes, no prices, no sizes; a size of 0 means do not quote
+
+    yes_bids, yes_asks = books['yes_bids'], books['yes_asks']
+    net_positions = books['net_positions']
+
+    # if the market is trading too close to 0 or 100, do not place any orders
+    edge_prob = (yes_bids + yes_asks) / 2
+    tradable = (edge_prob <= config.YES_BID_UPPER) & (edge_prob >= config.YES_BID_LOWER)
+    tradable &= (yes_bids != 0) & (yes_asks != 100)
+
+    # if large long (short) position, do not place any more buy (sell) orders
+    trade_yes = tradable & (net_positions < config.MAX_NET_EXPOSRE_PER_BOOK)
+    trade_no = tradable & (net_positions > -config.MAX_NET_EXPOSRE_PER_BOOK)
+    for ticker, net_position in zip(books['tickers'][tradable & ~(trade_yes & trade_no)],
+                                    net_positions[tradable & ~(trade_yes & trade_no)]):
+        print('RISK LIMIT BREACHED: ', ticker)
+        print(net_position, '\n')
+
+    # if best bid and offer are only 1 apart, do not dime (quote 1 tick inside); otherwise do
+    dime = (yes_asks - yes_bids != 1).astype(np.float64)
+
+    # bid at the minimum of (dimed) best bid and fair price - edge
+    # the bot will never attempt to trade at negative expected value
+    # and it will never bid higher than it needs to
+    # no bids are the same as yes asks
+    yes_prices = np.maximum(np.minimum(yes_bids + dime, theos - config.MIN_EDGE), 0)
+    no_prices = 100 - np.minimum(np.maximum(yes_asks - dime, theos + config.MIN_EDGE), 100)
+
+    # a yes order adds long exposure and a no order adds short exposure,
+    # so each side can only use the room left between the current net and the portfolio cap
+    yes_room = config.MAX_NET_EXPOSRE - net_exposure - reserved[0]
+    no_room = config.MAX_NET_EXPOSRE + net_exposure - reserved[1]
+    yes_sizes = size_to_cap(yes_prices, theos - yes_prices, trade_yes, yes_room)
+    no_sizes = size_to_cap(no_prices, (100 - theos) - no_prices, trade_no, no_room)
+
+    return yes_prices, yes_sizes, no_prices, no_sizes
+
+def size_to_cap(prices, edges, active, room):
+    # size orders so that, if all of them fill, the added exposure stays within room
+    # orders with the most edge are funded first; the order that reaches the cap is sized down
+    # and everything after it is skipped
+
+    sizes = np.zeros(len(prices), dtype=np.int64)
+    order = np.argsort(-edges[active], kind='stable')
+    idx = np.flatnonzero(active)[order]
+
+    # exposure used by all better orders at full size, i.e. what is left before each order
+    full_cost = config.UNIT_SIZE_CTS * prices[idx]
+    left = room - (np.cumsum(full_cost) - full_cost)
+
+    # contracts affordable out of what is left, capped at the unit size
+    safe_prices = np.where(prices[idx] > 0, prices[idx], 1)
+    affordable = np.where(prices[idx] > 0, np.floor(np.maximum(left, 0) / safe_prices), config.UNIT_SIZE_CTS)
+    sizes[idx] = np.minimum(affordable, config.UNIT_SIZE_CTS)
+
+    if room <= 0 or np.any(sizes[idx] < config.UNIT_SIZE_CTS):
+        print('PORTFOLIO LIMIT REACHED, ROOM:', room)
+    return sizes
+
+def create_orders(most_recent_cutoff, theo_fn=None, week_ahead=0, reserved=(0, 0)):
     # logic to create orders
+    # theo_fn - optional fair value function with the signature of get_yes_probs, e.g. for offline replay
+    # week_ahead - which upcoming event to quote, 0 being the current one
+    # reserved - (long, short) exposure of orders already created for other events, see quote_markets
 
-    yes = {} # will store yes orders
-    no = {} # will store no orders
-    event_ticker = construct_event_ticker(most_recent_cutoff) # e.g. KXTSAW-25JUL20
+    if theo_fn is None:
+        theo_fn = get_yes_probs
+
+    event_ticker = construct_event_ticker(most_recent_cutoff, week_ahead) # e.g. KXTSAW-25JUL20
     print('EVENT TICKER:', event_ticker)
 
     # get all the markets in the event
     markets = get_markets(config.KEY_PATH, config.ACCESS_KEY, 'GET', config.BASE_URL,
                           config.MARKETS_PATH, {'event_ticker': event_ticker})
-    # get existing positions
+    # get existing positions across every market, so the portfolio-wide cap can be enforced
     positions = get_positions(config.KEY_PATH, config.ACCESS_KEY, 'GET', config.BASE_URL,
-                          config.POSITIONS_PATH, {'event_ticker': event_ticker})
-
-    # place orders for each market
-    for market in markets:
-        trade_yes = True
-        trade_no = True
-        dime = True # if True, quote 1 tick above (below) best bid (offer)
-        
-        # calc net position in this market
-        net_position = calc_net_position_ticker(market['ticker'], positions)
-        if net_position <= -config.MAX_NET_EXPOSRE_PER_BOOK:
-            # if large short position, do not place any more sell orders
-            print('RISK LIMIT BREACHED: ', market['ticker'])
-            print(net_position, '\n')
-            trade_no = False
-        if net_position >= config.MAX_NET_EXPOSRE_PER_BOOK:
-            # if large long position, do not place any more buy orders
-            print('RISK LIMIT BREACHED: ', market['ticker'])
-            print(net_position, '\n')
-            trade_yes = False
-        
-
-        # if the market is trading too close to 0 or 100, do not place any orders
-        edge_prob = (market['yes_bid'] + market['yes_ask']) / 2
-        if edge_prob > config.YES_BID_UPPER or edge_prob < config.YES_BID_LOWER:
-            continue
-        if market['yes_bid'] == 0 or market['yes_ask'] == 100:
-            continue
-
-        # calculate fair price for the given strike by reading simulation results
-        strike = market['floor_strike']
-        most_recent_date_string = construct_file_name(most_recent_cutoff)
-        theo = get_yes_prob(most_recent_date_string, strike)
-        print('\n')
-        print(market['ticker'], ' THEO:', theo)
-        
-
-        # if best bid and offer are only 1 apart, do not dime; otherwise do
-        if market['yes_ask'] - market['yes_bid'] == 1:
-            dime = False
-        
-        if trade_yes:
-            # place buy order at minimum of best bid and fair price - edge
-            # the bot will never attempt to trade at negative expected value
-            # and it will never bid higher than it needs to
-            if dime:
-                yes_bid = max(min(market['yes_bid'] + 1, theo - config.MIN_EDGE), 0)
-            else:
-                yes_bid = max(min(market['yes_bid'], theo - config.MIN_EDGE), 0)
-            
-            # add yes order for that ticker to dict
-            yes[market['ticker']] = yes_bid
-        
-        if trade_no:
-            # same logic as yes orders
-            # no bids are the same as yes asks
-            if dime:
-                no_bid = 100 - min(max(market['yes_ask'] - 1, theo + config.MIN_EDGE), 100)
-            else:
-                no_bid = 100 - min(max(market['yes_ask'], theo + config.MIN_EDGE), 100)
-
-            no[market['ticker']] = no_bid
-    
+                              config.POSITIONS_PATH, {'limit': 1000})
+    net_exposure = calc_net_position(config.TSA_TICKER_START, positions)
+    print('PORTFOLIO NET EXPOSURE:', net_exposure)
+
+    books = market_arrays(markets, positions)
+
+    # calculate fair prices for every strike by reading simulation results once
+    most_recent_date_string = construct_file_name(most_recent_cutoff)
+    theos = theo_fn(most_recent_date_string, books['strikes'], week_ahead)
+    if theos is None:
+        print('NO SIMULATIONS FOR', event_ticker)
+        return {}, {}
+    theos = np.asarray(theos, dtype=np.float64)
+    for ticker, theo in zip(books['tickers'], theos):
+        print(ticker, ' THEO:', theo)
+
+    yes_prices, yes_sizes, no_prices, no_sizes = quote_markets(books, theos, net_exposure, reserved)
+
+    # dicts mapping ticker -> (price, contracts)
+    yes = {ticker: (int(price), int(size))
+           for ticker, price, size in zip(books['tickers'], yes_prices, yes_sizes) if size > 0}
+    no = {ticker: (int(price), int(size))
+          for ticker, price, size in zip(books['tickers'], no_prices, no_sizes) if size > 0}
 
     print('\nORDERS TO PLACE')
     print('YES:', yes)
@@ -159,10 +236,10 @@ def send_order(ticker, count, side, price):
             config.BASE_URL, config.ORDERS_PATH, params)
     
 def send_orders(order_dict, side):
-    # given yes or no order dict, place each order
+    # given yes or no order dict mapping ticker -> (price, contracts), place each order
 
-    for ticker, price in order_dict.items():
-        send_order(ticker, config.UNIT_SIZE_CTS, side, price)
+    for ticker, (price, count) in order_dict.items():
+        send_order(ticker, count, side, price)
     print(side.upper(), 'ORDERS PLACED SUCCESSFULLY')
 
 def cancel_orders(order_ids):
@@ -174,6 +251,14 @@ def cancel_orders(order_ids):
         call_api(config.KEY_PATH, config.ACCESS_KEY, 'DELETE',
                  config.BASE_URL, cancel_path, params)
 
+def order_exposure(order_dict):
+    # exposure added if every order in a ticker -> (price, contracts) dict fills
+    return sum(price * count for price, count in order_dict.values())
+
+def event_tickers(most_recent_date):
+    # every event quoted off the simulations, the current one first
+    return [construct_event_ticker(most_recent_date, week_ahead) for week_ahead in range(config.FORECAST_WEEKS)]
+
 def get_order_ids(event_ticker):
     # for an event, get active order ids across all markets
     # return list of ids
@@ -186,20 +271,36 @@ def get_order_ids(event_ticker):
     return order_ids
 
 
+def requote_events(most_recent_date, theo_fn=None):
+    # cancel the resting orders of every quoted event and create each event's new orders
+    # theo_fn - optional fair value function, see create_orders
+    # returns list of (yes, no) order dicts, one per event, the current one first; nothing is sent here
+
+    # cancel all existing orders in every quoted event
+    for event_ticker in event_tickers(most_recent_date):
+        order_ids = get_order_ids(event_ticker)
+        cancel_orders(order_ids)
+
+    # create order dicts according to create_orders logic, one event at a time
+    # exposure of earlier events' orders is reserved so all of them together stay within the portfolio cap
+    orders = []
+    reserved = (0, 0)
+    for week_ahead in range(config.FORECAST_WEEKS):
+        yes, no = create_orders(most_recent_date, theo_fn, week_ahead, reserved)
+        orders.append((yes, no))
+        reserved = (reserved[0] + order_exposure(yes), reserved[1] + order_exposure(no))
+    return orders
+
+@profiled('trader_main')
 def trader_main():
     # function to place orders
 
-    # cancel all existing orders
     most_recent_date = get_most_recent_date()
-    event_ticker = construct_event_ticker(most_recent_date)
-    order_ids = get_order_ids(event_ticker)
-    cancel_orders(order_ids)
-
-    # create order dicts according to create_orders logic
-    yes, no = create_orders(most_recent_date)
+    orders = requote_events(most_recent_date)
 
     time.sleep(5)
 
     # place the new orders
-    send_orders(yes, 'yes')
-    send_orders(no, 'no')
+    for yes, no in orders:
+        send_orders(yes, 'yes')
+        send_orders(no, 'no')